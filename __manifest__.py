@@ -10,13 +10,17 @@
     'qweb': [],
     'description': False,
     'images': [],
-    'version': '1.0.1.12',
+    'version': '1.0.1.14',
     'category': 'Manufacturing/Manufacturing',
     'demo': [],
     'depends': ['mrp_production_packaging'],
     'data': [
+        'security/ir.model.access.csv',
+        'data/ir_cron_data.xml',
         'views/mrp_production_views.xml',
-        'views/stock_move_line_views.xml'
+        'views/mrp_production_pack_job_views.xml',
+        'views/stock_move_line_views.xml',
+        'report/mrp_production_packaging_report_views.xml',
     ],
     'license': 'LGPL-3',
 }
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import odoo
+from odoo import api, http
+from odoo.http import request
+from werkzeug.wrappers import Response
+
+LABEL_CONTENT_TYPES = {
+    'csv': 'text/csv;charset=utf-8',
+    'zpl': 'application/zpl;charset=utf-8',
+}
+
+
+class MrpProductionPackagesController(http.Controller):
+
+    @http.route('/mrp_production_packs/<int:production_id>/labels.<any(csv,zpl):label_format>', type='http',
+                auth='user')
+    def export_package_labels(self, production_id, label_format, **kwargs):
+        production = request.env['mrp.production'].browse(production_id).exists()
+        if not production:
+            return request.not_found()
+        production.check_access_rights('read')
+        production.check_access_rule('read')
+        filename = '%s-labels.%s' % (production.name.replace('/', '_'), label_format)
+        dbname, uid, context = request.env.cr.dbname, request.env.uid, dict(request.env.context)
+
+        def _generate_labels():
+            # the request cursor is closed once the response is returned, the labels are streamed with their own one
+            with odoo.registry(dbname).cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                for chunk in env['mrp.production'].browse(production_id)._export_package_labels(label_format):
+                    yield chunk.encode('utf-8')
+
+        return Response(_generate_labels(), direct_passthrough=True, headers=[
+            ('Content-Type', LABEL_CONTENT_TYPES[label_format]),
+            ('Content-Disposition', http.content_disposition(filename)),
+        ])
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+
+def migrate(cr, version):
+    """ Link the existing packages to the manufacturing order and the finished move line put in them, the sequence of
+    the packages in their manufacturing order follows the creation order of the packages """
+    if not version:
+        return
+    cr.execute("""
+        WITH package_link AS (
+            SELECT DISTINCT ON (move_line.result_package_id)
+                   move_line.result_package_id AS package_id,
+                   move.production_id,
+                   move_line.id AS move_line_id
+              FROM stock_move_line move_line
+              JOIN stock_move move ON move.id = move_line.move_id
+             WHERE move.production_id IS NOT NULL
+               AND move_line.result_package_id IS NOT NULL
+          ORDER BY move_line.result_package_id, move_line.state = 'assigned' DESC, move_line.id
+        )
+        UPDATE stock_quant_package package
+           SET production_id = package_link.production_id,
+               production_move_line_id = package_link.move_line_id,
+               production_sequence = package_link.sequence
+          FROM (SELECT package_link.*,
+                       ROW_NUMBER() OVER (PARTITION BY package_link.production_id
+                                          ORDER BY package_link.package_id) AS sequence
+                  FROM package_link) package_link
+         WHERE package.id = package_link.package_id
+    """)
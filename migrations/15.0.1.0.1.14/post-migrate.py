@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, SUPERUSER_ID
+
+
+def migrate(cr, version):
+    """ Build the sale order allocations of the packages of the manufacturing orders still in progress """
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    productions = env['stock.quant.package'].search([
+        ('production_id.state', 'not in', ('done', 'cancel'))]).production_id
+    productions._rebuild_package_allocations()
@@ -1,3 +1,5 @@
 # -*- coding: utf-8 -*-
 from . import mrp_production
-from . import stock_quant
\ No newline at end of file
+from . import stock_quant
+from . import mrp_production_pack_job
+from . import mrp_production_package_allocation
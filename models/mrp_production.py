@@ -1,8 +1,43 @@
 # -*- coding: utf-8 -*- 
 
+import csv
+import io
+import math
+import threading
+import uuid
+
+from psycopg2 import OperationalError, errorcodes
+
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError, ValidationError
-from odoo.tools.float_utils import float_compare, float_is_zero, float_round
+from odoo.tools import split_every
+from odoo.tools.float_utils import float_compare, float_round
+
+from .mrp_production_pack_job import PACK_JOB_ACTIVE_STATES
+from .stock_quant import MRP_PRODUCTION_LINKED_SALE_ORDERS_FIELD
+from ..tools.pack_profiling import profile_pack_operation, count_pack_operation
+from ..tools.packing_planner import (
+    plan_partial_split, plan_packaging_split, plan_mixed_split, plan_refresh, plan_reconcile)
+
+PUT_IN_PACK_BATCH_SIZE_PARAM = 'mrp_production_packs_according_packaging.put_in_pack_batch_size'
+PUT_IN_PACK_BATCH_SIZE = 20
+ASYNC_PACK_THRESHOLD_PARAM = 'mrp_production_packs_according_packaging.async_pack_threshold'
+ASYNC_PACK_THRESHOLD = 1000
+PACKAGE_NAMES_DISPLAY_LIMIT = 10
+RESET_PACKAGES_MODE_PARAM = 'mrp_production_packs_according_packaging.reset_packages_mode'
+PACKAGE_LABELS_CHUNK_SIZE = 1000
+PACKAGE_LABEL_FIELDS = ['name', 'lot', 'partner', 'product', 'prepress_proof', 'quantity', 'sale_order']
+PACKAGE_ZPL_LABEL = """^XA
+^CF0,30
+^FO30,30^FD%(name)s^FS
+^FO30,70^FD%(product)s^FS
+^FO30,110^FD%(partner)s^FS
+^FO30,150^FDLot: %(lot)s / %(prepress_proof)s^FS
+^FO30,190^FDQty: %(quantity)s^FS
+^FO30,230^FD%(sale_order)s^FS
+^FO30,280^BCN,80,Y,N,N^FD%(name)s^FS
+^XZ
+"""
 
 
 class MrpProduction(models.Model):
@@ -14,34 +49,122 @@ class MrpProduction(models.Model):
         help='Check the existence of destination packages on move lines')
     packages_to_refresh = fields.Boolean(compute='_compute_packages_to_refresh')
     packages_to_reset = fields.Boolean(compute='_compute_packages_to_reset')
+    package_move_line_ids = fields.Many2many(
+        'stock.move.line', compute='_compute_package_move_line_ids',
+        help='Finished move lines put in packages, ordered by package')
+    packing_mode = fields.Selection([
+        ('packaging', 'Selected Packaging'),
+        ('mixed', 'All Packagings'),
+        ('nested', 'Nested Packagings')], string='Packing Mode', default='packaging', required=True,
+        help="Selected Packaging: the products are put in packs of the selected packaging.\n"
+             "All Packagings: the products are put in packs of the biggest packagings of the product first, the "
+             "remaining quantities going to the smaller ones.\n"
+             "Nested Packagings: the packs of the selected packaging are put in packs of the bigger packagings of the "
+             "product, as cartons on a pallet.")
+    package_count = fields.Integer('Packages', compute='_compute_packaging_statistics')
+    incomplete_package_count = fields.Integer('Incomplete Packages', compute='_compute_packaging_statistics')
+    packed_qty = fields.Float('Packed Quantity', digits='Product Unit of Measure',
+                              compute='_compute_packaging_statistics')
+    pack_idempotency_token = fields.Char(
+        copy=False, readonly=True,
+        help='Token of the last packing operation done on this manufacturing order, a second call of the operation '
+             'with the same token is ignored')
+    pack_next_idempotency_token = fields.Char(
+        copy=False, readonly=True, default=lambda self: uuid.uuid4().hex,
+        help='Token given by the packing buttons of the form to their operation, it is renewed by each packing '
+             'operation so that a button clicked twice on the same form only packs once')
+    pack_job_ids = fields.One2many('mrp.production.pack.job', 'production_id', 'Packing Jobs')
+    pack_job_state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running')], compute='_compute_pack_job_state',
+        help='State of the packing job processing the packages of this manufacturing order in background')
+    pack_job_package_count = fields.Integer(compute='_compute_pack_job_state')
+
+    @api.depends('pack_job_ids.state')
+    def _compute_pack_job_state(self):
+        for each in self:
+            active_jobs = each.pack_job_ids.filtered(lambda job: job.state in PACK_JOB_ACTIVE_STATES)
+            each.pack_job_state = active_jobs[:1].state
+            each.pack_job_package_count = sum(active_jobs.mapped('package_count'))
 
-    @api.depends('qty_by_packaging')
+    @api.depends('qty_by_packaging', 'packing_mode')
     def _compute_packages_to_reset(self):
+        packages_data = self._get_packages_data()
         for each in self:
-            if not each._get_related_packages():
+            package_count = packages_data[each.id]['package_count']
+            if not package_count:
                 each.packages_to_reset = False
+            elif each.packing_mode != 'packaging':
+                # the packages of several packagings can't be refreshed, any change of the quantity resets them
+                each.packages_to_reset = float_compare(each.qty_producing, packages_data[each.id]['packed_qty'],
+                                                       precision_rounding=each.product_uom_id.rounding) != 0
             elif float_compare(each.qty_producing,
-                               each.qty_by_packaging * len(each._get_related_packages()) - (each.qty_by_packaging-each.incomplete_qty),
+                               each.qty_by_packaging * package_count - (each.qty_by_packaging-each.incomplete_qty),
                                precision_rounding=each.product_uom_id.rounding) != 0:
                 each.packages_to_reset = True
             else:
                 each.packages_to_reset = False
 
-    @api.depends('qty_producing')
+    @api.depends('qty_producing', 'packing_mode')
     def _compute_packages_to_refresh(self):
+        packages_data = self._get_packages_data()
         for each in self:
-            if not each._get_related_packages():
+            if not packages_data[each.id]['package_count'] or each.packing_mode != 'packaging':
                 each.packages_to_refresh = False
-            elif float_compare(each.qty_producing, each.move_finished_ids.filtered(
-                    lambda mv: mv.product_id.id == each.product_id.id and mv.state != 'cancel').quantity_done,
+            elif float_compare(each.qty_producing, packages_data[each.id]['quantity_done'],
                                precision_rounding=each.product_uom_id.rounding) != 0:
                 each.packages_to_refresh = True
             else:
                 each.packages_to_refresh = False
 
     def _compute_has_packages(self):
+        packages_data = self._get_packages_data()
         for mrp_production in self:
-            mrp_production.has_packages = mrp_production._get_related_packages_move_lines(count_only=True) > 0
+            mrp_production.has_packages = packages_data[mrp_production.id]['move_line_count'] > 0
+
+    def _compute_packaging_statistics(self):
+        # the statistics of all the orders are read from the packaging report view in one query
+        self.env['stock.move.line'].flush(['qty_done', 'result_package_id', 'move_id'])
+        statistics = {statistic['production_id'][0]: statistic for statistic in
+                      self.env['mrp.production.packaging.report'].search_read(
+                          [('production_id', 'in', self._origin.ids)],
+                          ['production_id', 'package_count', 'incomplete_package_count', 'packed_qty'])}
+        for each in self:
+            statistic = statistics.get(each._origin.id, {})
+            each.package_count = statistic.get('package_count', 0)
+            each.incomplete_package_count = statistic.get('incomplete_package_count', 0)
+            each.packed_qty = statistic.get('packed_qty', 0.0)
+
+    def _get_packages_data(self):
+        """ Return for each manufacturing order of self the number of its packed finished move lines, the number of
+        packages and the packed quantity of its finished product and the quantity done of its finished product moves,
+        the packed move lines of all the orders are grouped in one query """
+        packages_data = {each.id: {'move_line_count': 0, 'package_count': 0, 'packed_qty': 0.0, 'quantity_done': 0.0}
+                         for each in self}
+        for each in self:
+            packages_data[each.id]['quantity_done'] = sum(each.move_finished_ids.filtered(
+                lambda mv: mv.product_id.id == each.product_id.id and mv.state != 'cancel').mapped('quantity_done'))
+        # the packed move lines are only in database, so we group them on the moves of the saved orders
+        saved_moves = self.move_finished_ids._origin
+        if not saved_moves:
+            return packages_data
+        production_move_by_move_id = {}
+        for each in self:
+            for move in each.move_finished_ids._origin:
+                production_move_by_move_id[move.id] = (each, move)
+        groups = self.env['stock.move.line'].read_group(
+            [('move_id', 'in', saved_moves.ids), ('result_package_id', '!=', False)],
+            ['move_id', 'result_package_id:count_distinct', 'qty_done:sum'], ['move_id'], lazy=False)
+        for group in groups:
+            if group['move_id'][0] not in production_move_by_move_id:
+                continue
+            production, move = production_move_by_move_id[group['move_id'][0]]
+            order_packages_data = packages_data[production.id]
+            order_packages_data['move_line_count'] += group['__count']
+            if move.product_id.id == production.product_id.id:
+                order_packages_data['package_count'] += group['result_package_id']
+                order_packages_data['packed_qty'] += group['qty_done']
+        return packages_data
 
     def action_see_packages(self):
         self.ensure_one()
@@ -51,35 +174,268 @@ class MrpProduction(models.Model):
         action['context'] = {'production_id': self.id, 'print_forcasted_content': True}
         return action
 
+    def action_export_package_labels(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/mrp_production_packs/%s/labels.%s' % (self.id, self.env.context.get('label_format', 'csv')),
+            'target': 'self',
+        }
+
+    def _iter_package_labels(self, chunk_size=PACKAGE_LABELS_CHUNK_SIZE):
+        """ Yield the forecasted content of the packages of the order, in the order of the packages, with one label by
+        sale order allocated to a package shared by several sale orders. The packages and their allocations are read
+        by chunks of chunk_size, with one search of the allocation table by chunk, and dropped from the cache once
+        yielded """
+        self.ensure_one()
+        Package = self.env['stock.quant.package']
+        package_ids = Package.search([('production_id', '=', self.id),
+                                      ('production_move_line_id.state', '=', 'assigned')], order='id').ids
+        # the content common to all the packages of the order is read once
+        common_label = {
+            'lot': self.lot_producing_id.name or '',
+            'partner': self.product_id.partner_id.display_name or '',
+            'product': self.product_id.display_name,
+            'prepress_proof': self.prepress_proof_id.display_name or '',
+        }
+        for package_ids_chunk in split_every(chunk_size, package_ids):
+            packages = Package.browse(package_ids_chunk)
+            allocations_by_package = packages._get_sale_order_allocations()
+            move_line_ids = packages.production_move_line_id.ids
+            for package in packages:
+                allocations = allocations_by_package.get(package.id) \
+                              or [(False, package.production_move_line_id.product_uom_qty)]
+                for sale_order, quantity in allocations:
+                    yield dict(common_label, name=package.name, quantity=quantity,
+                               sale_order=sale_order and sale_order.name or '')
+            Package.invalidate_cache(ids=package_ids_chunk)
+            self.env['stock.move.line'].invalidate_cache(ids=move_line_ids)
+            self.env['mrp.production.package.allocation'].invalidate_cache()
+
+    def _export_package_labels(self, label_format='csv'):
+        """ Yield the labels of the packages of the order as text chunks, in CSV or in ZPL for label printers """
+        self.ensure_one()
+        if label_format == 'zpl':
+            for label in self._iter_package_labels():
+                # ^ and ~ are ZPL commands prefixes, they can't be printed as field data
+                yield PACKAGE_ZPL_LABEL % {key: str(value).replace('^', ' ').replace('~', ' ')
+                                           for key, value in label.items()}
+            return
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=PACKAGE_LABEL_FIELDS)
+        writer.writeheader()
+        for label in self._iter_package_labels():
+            writer.writerow(label)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    @api.depends('move_finished_ids.move_line_ids.result_package_id', 'move_finished_ids.move_line_ids.qty_done',
+                 'move_finished_ids.move_line_ids.product_uom_qty')
+    def _compute_package_move_line_ids(self):
+        for each in self:
+            each.package_move_line_ids = each.move_finished_ids.move_line_ids.filtered(
+                lambda ml: ml.result_package_id).sorted(lambda ml: (ml.result_package_id.id, ml.id))
+
     def _get_related_packages_move_lines(self, count_only=False, order='id ASC', limit=False):
         self.ensure_one()
-        domain = [('move_id', 'in', self.move_finished_ids.ids), ('result_package_id', '!=', False)]
+        # the package move lines are read from the cached package_move_line_ids, which is invalidated by any change
+        # of the finished move lines packages or quantities
+        move_lines = self.package_move_line_ids
         if count_only:
-            return self.env['stock.move.line'].search_count(domain)
+            return len(move_lines)
+        if order == 'result_package_id DESC':
+            move_lines = move_lines[::-1]
+        elif order == 'id ASC':
+            move_lines = move_lines.sorted('id')
+        else:
+            move_lines = self.env['stock.move.line'].search([('id', 'in', move_lines.ids)], order=order)
         if limit:
-            return self.env['stock.move.line'].search(domain, order=order, limit=limit)
-        return self.env['stock.move.line'].search(domain, order=order)
+            return move_lines[:limit]
+        return move_lines
 
     def _get_related_packages(self):
-        packages = self.finished_move_line_ids.filtered(lambda ml: ml.product_id.id == self.product_id.id).mapped(
-            'result_package_id')
+        # the packages are returned by descending package as the finished move lines are ordered
+        packages = self.package_move_line_ids[::-1].filtered(
+            lambda ml: ml.product_id.id == self.product_id.id).mapped('result_package_id')
         return packages
 
     def _check_action_put_in_pack(self):
+        self.ensure_one()
+        error_message = self._get_put_in_pack_error()
+        if error_message:
+            raise ValidationError(error_message)
+
+    def _get_put_in_pack_error(self):
+        """ Return the reason why the manufacturing order can not be put in pack, False if it can """
         self.ensure_one()
         if self.state in ('draft', 'done', 'cancel'):
-            raise ValidationError(_("Can not Put in pack in this state!"))
+            return _("Can not Put in pack in this state!")
         if self.has_packages:
-            raise ValidationError(_("This manufacturing has already generate packages!"))
+            return _("This manufacturing has already generate packages!")
         if not self.product_packaging_id:
-            raise ValidationError(_("Packaging is not specified!"))
+            return _("Packaging is not specified!")
         if float_compare(self.qty_producing, 0.0, precision_rounding=self.product_uom_id.rounding) <= 0:
-            raise ValidationError(_("Quantity Producing is not specified!"))
+            return _("Quantity Producing is not specified!")
+        return False
+
+    def action_put_in_pack_batch(self):
+        result = self._put_in_pack_batch()
+        messages = [_("%s manufacturing orders packed, %s queued, %s skipped, %s failed.") % (
+            len(result['packed']), len(result['queued']), len(result['skipped']), len(result['failed']))]
+        for production, error_message in list(result['skipped'].items()) + list(result['failed'].items()):
+            messages.append("%s: %s" % (production.name, error_message))
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Put in Pack'),
+                'message': '\n'.join(messages),
+                'type': result['failed'] and 'warning' or 'success',
+                'sticky': bool(result['failed']),
+            },
+        }
+
+    def _put_in_pack_batch(self):
+        """ Put in pack all the manufacturing orders of self, grouped by packaging, committing after each chunk of
+        orders so that a big batch doesn't hold its locks until the end. The orders that can't be put in pack are
+        skipped and the ones raising an error are rolled back without stopping the batch, return the packed orders, the
+        orders queued as background jobs and the skipped and failed orders with their reason """
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param(
+            PUT_IN_PACK_BATCH_SIZE_PARAM, PUT_IN_PACK_BATCH_SIZE)) or PUT_IN_PACK_BATCH_SIZE
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        result = {'packed': self.browse(), 'queued': self.browse(), 'skipped': {}, 'failed': {}}
+        productions_by_packaging = {}
+        for production in self:
+            productions_by_packaging.setdefault(production.product_packaging_id, self.browse())
+            productions_by_packaging[production.product_packaging_id] |= production
+        for packaging, productions in productions_by_packaging.items():
+            for productions_chunk in split_every(batch_size, productions.ids, self.browse):
+                for production in productions_chunk:
+                    error_message = production._get_put_in_pack_error()
+                    if error_message:
+                        result['skipped'][production] = error_message
+                        continue
+                    try:
+                        with self.env.cr.savepoint():
+                            production.action_put_in_pack()
+                        # the orders with too many packs are only queued, they are packed later in background
+                        if production.pack_job_state:
+                            result['queued'] |= production
+                        else:
+                            result['packed'] |= production
+                    except (UserError, ValidationError) as error:
+                        self.invalidate_cache()
+                        result['failed'][production] = error.args[0]
+                if auto_commit:
+                    self.env.cr.commit()
+        return result
+
+    def _check_pack_job(self):
+        if self.env.context.get('pack_job_running'):
+            return
+        for each in self:
+            if each.pack_job_state:
+                raise UserError(_("The packages of %s are being processed in background, please wait until the job "
+                                  "is done.") % each.name)
+
+    def _get_estimated_package_count(self, operation):
+        """ Return the number of packages the packing operation should create or remove """
+        self.ensure_one()
+        if not self.product_packaging_id.qty:
+            return 0
+        if operation == 'refresh':
+            quantity = abs(self.qty_producing - sum(self.move_finished_ids.filtered(
+                lambda mv: mv.product_id.id == self.product_id.id).mapped('quantity_done')))
+        else:
+            quantity = self.qty_producing
+        return math.ceil(quantity / self.product_packaging_id.qty)
+
+    def _queue_pack_jobs(self, operation):
+        """ Queue a background job for the orders of self whose packing operation exceeds the package count threshold,
+        return the queued orders """
+        if self.env.context.get('pack_job_running'):
+            return self.browse()
+        threshold = int(self.env['ir.config_parameter'].sudo().get_param(
+            ASYNC_PACK_THRESHOLD_PARAM, ASYNC_PACK_THRESHOLD))
+        if threshold <= 0:
+            return self.browse()
+        package_count_by_production = {each: each._get_estimated_package_count(operation) for each in self}
+        productions_to_queue = self.filtered(lambda mrp: package_count_by_production[mrp] > threshold)
+        if productions_to_queue:
+            self.env['mrp.production.pack.job'].create([{
+                'production_id': production.id,
+                'operation': operation,
+                'package_count': package_count_by_production[production],
+            } for production in productions_to_queue])
+            self.env.ref('mrp_production_packs_according_packaging.ir_cron_process_pack_jobs')._trigger()
+        return productions_to_queue
+
+    def action_cancel_pack_jobs(self):
+        self.pack_job_ids.action_cancel()
 
+    def _action_notify_pack_jobs(self):
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Packages'),
+                'message': _("The packages of %s will be processed in background, you will be notified by an activity "
+                             "once they are ready.") % ", ".join(self.mapped('name')),
+                'type': 'info',
+                'next': {'type': 'ir.actions.client', 'tag': 'reload'},
+            },
+        }
+
+    def _lock_for_packing(self):
+        """ Lock the manufacturing orders rows for a packing operation, failing at once if another transaction is
+        packing them. Return False if the operation identified by the pack_idempotency_token of the context has already
+        been done on all the orders, True otherwise """
+        if not self:
+            return True
+        try:
+            with self.env.cr.savepoint(flush=False):
+                self.env.cr.execute("SELECT id FROM mrp_production WHERE id IN %s FOR UPDATE NOWAIT",
+                                    (tuple(self.ids),))
+        except OperationalError as error:
+            if error.pgcode == errorcodes.LOCK_NOT_AVAILABLE:
+                raise UserError(_("The packages of %s are already being processed, please try again in a moment.")
+                                % ", ".join(self.mapped('name')))
+            raise
+        # the packages may have been changed by the transaction which held the lock
+        self.invalidate_cache(['has_packages', 'packages_to_refresh', 'packages_to_reset', 'package_move_line_ids',
+                               'pack_idempotency_token'], self.ids)
+        token = self.env.context.get('pack_idempotency_token')
+        if token and all(each.pack_idempotency_token == token for each in self):
+            return False
+        # the rows are always written, so that a concurrent operation which started before this one commits fails to
+        # lock them and is retried on the new packages instead of redoing the work on outdated ones
+        self.write({'pack_idempotency_token': token or False, 'pack_next_idempotency_token': uuid.uuid4().hex})
+        return True
+
+    def _action_notify_pack_operation_done(self):
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Packages'),
+                'message': _("The packages of %s have already been processed.") % ", ".join(self.mapped('name')),
+                'type': 'info',
+                'next': {'type': 'ir.actions.client', 'tag': 'reload'},
+            },
+        }
+
+    @profile_pack_operation
     def action_put_in_pack(self):
+        if not self._lock_for_packing():
+            return self._action_notify_pack_operation_done()
+        self._check_pack_job()
         self._check_action_put_in_pack()
-        # FIXME:here we assume that the move_finished_ids is allways singleton
-        if float_compare(self.qty_producing, self.move_finished_ids.quantity_done,
+        if self._queue_pack_jobs('put_in_pack'):
+            return self._action_notify_pack_jobs()
+        if float_compare(self.qty_producing, sum(self.move_finished_ids.filtered(
+                lambda mv: mv.product_id.id == self.product_id.id).mapped('quantity_done')),
                          precision_rounding=self.product_uom_id.rounding) != 0:
             self._update_move_finished_ids()
         # allways we try to assign the move_finished as they can be returned for any reason to 'confirmed' state
@@ -98,6 +454,7 @@ class MrpProduction(models.Model):
                     precision_rounding=ml.product_uom_id.rounding) == 0)
             if move_line_ids:
                 res = self._put_in_pack_according_to_packaging(move_line_ids, create_package_level=False)
+                self._rebuild_package_allocations()
                 return res
             else:
                 raise UserError(
@@ -108,9 +465,9 @@ class MrpProduction(models.Model):
         self.move_finished_ids.filtered(
             lambda mv: mv.product_id.id == self.product_id.id).quantity_done = self.qty_producing
 
+    @profile_pack_operation
     def _put_in_pack_according_to_packaging(self, move_line_ids, create_package_level=True):
         packages = self.env['stock.quant.package']
-        precision_digits = self.env['decimal.precision'].precision_get('Product Unit of Measure')
         # Each move has its own packaging so at least we have to create as packags as moves ,however if no packaging has been specified ,we have to return to
         # the super method as this new method has no reason to be used
         product_packagings = move_line_ids.move_id.product_packaging_id
@@ -120,19 +477,17 @@ class MrpProduction(models.Model):
         for packaging in product_packagings:
             move_lines_to_pack = self.env['stock.move.line']
             for packaging_move_line in move_line_ids.filtered(lambda ml: ml.move_id.product_packaging_id == packaging):
-                if float_is_zero(packaging_move_line.qty_done, precision_digits=precision_digits):
-                    packaging_move_line.qty_done = packaging_move_line.product_uom_qty
-                if float_compare(packaging_move_line.qty_done, packaging_move_line.product_uom_qty,
-                                 precision_rounding=packaging_move_line.product_uom_id.rounding) >= 0:
+                quantity_to_pack, quantity_left_todo = plan_partial_split(
+                    packaging_move_line.qty_done, packaging_move_line.product_uom_qty,
+                    packaging_move_line.product_uom_id.rounding)
+                if not quantity_left_todo:
+                    if packaging_move_line.qty_done != quantity_to_pack:
+                        packaging_move_line.qty_done = quantity_to_pack
                     move_lines_to_pack |= packaging_move_line
                 else:
-                    quantity_left_todo = float_round(
-                        packaging_move_line.product_uom_qty - packaging_move_line.qty_done,
-                        precision_rounding=packaging_move_line.product_uom_id.rounding,
-                        rounding_method='HALF-UP')
-                    done_to_keep = packaging_move_line.qty_done
                     new_move_line = packaging_move_line.copy(
-                        default={'product_uom_qty': 0, 'qty_done': packaging_move_line.qty_done})
+                        default={'product_uom_qty': 0, 'qty_done': quantity_to_pack})
+                    count_pack_operation('move_lines_split', 1)
                     vals = {'product_uom_qty': quantity_left_todo, 'qty_done': 0.0}
                     if self.picking_type_id.code == 'incoming':
                         if packaging_move_line.lot_id:
@@ -140,239 +495,437 @@ class MrpProduction(models.Model):
                         if packaging_move_line.lot_name:
                             vals['lot_name'] = False
                     packaging_move_line.write(vals)
-                    new_move_line.write({'product_uom_qty': done_to_keep})
+                    new_move_line.write({'product_uom_qty': quantity_to_pack})
                     move_lines_to_pack |= new_move_line
             move_lines_to_pack_by_packaging.update({packaging: move_lines_to_pack})
-        # we have to split move lines according to packaging and remove the origin ones
-        # move_lines_to_remove = self.env['stock.move.line']
+        # we work out the whole split plan first, so that all the packages and all the split move lines can be created
+        # with one multi-record create each instead of one create and one write by package
+        packing_plan = []
         for packaging, move_lines_to_pack in move_lines_to_pack_by_packaging.items():
             for move_line_to_pack in move_lines_to_pack:
-                nbr_of_packages = (move_line_to_pack.qty_done // packaging.qty)
-                last_package = (move_line_to_pack.qty_done % packaging.qty)
-                remaining_qty = move_line_to_pack.qty_done
-                # we have to split the found move line to the number of packages ,we have do nbr_of_packages-1 because we have to let the
-                # stock move line found
-                for pack_nbr in range(0, int(nbr_of_packages - 1)):
-                    # create packages as more as the number of packages found
-                    # the type of created packages must follow the type of packaging specified in the parent move
-                    # package = self.env['stock.quant.package'].create(
-                    #    {'package_type_id': packaging.package_type_id and packaging.package_type_id.id})
-                    new_move_line = move_line_to_pack.copy({
-                        'product_uom_qty': move_line_to_pack.state == 'assigned' and packaging.qty or 0.0,
-                        'qty_done': packaging.qty,
-                        # 'result_package_id': package.id
-                    })
-                    remaining_qty -= packaging.qty
-                    package = self._pack_move_line(new_move_line, packaging)
-                    packages |= package
-                    if create_package_level: self._create_package_level(new_move_line, package)
-                # if there is any remaining qty that doesn't reach the capacity of package ,we have to create new package and put it in
-                # we have to update the original splitted move line
-                if int(nbr_of_packages) > 0:
-                    # we have to do this check,because if the nbr_of_packages == 0 this mean that move line is not splitted at all because the qty_done is less then the qty contained by the package
-                    # package = self.env['stock.quant.package'].create(
-                    #    {'package_type_id': packaging.package_type_id and packaging.package_type_id.id})
-                    move_line_to_pack.write({
-                        'product_uom_qty': move_line_to_pack.state == 'assigned' and packaging.qty or 0.0,
-                        'qty_done': packaging.qty,
-                        # 'result_package_id': package.id
-                    })
-                    remaining_qty -= packaging.qty
-                    package = self._pack_move_line(move_line_to_pack, packaging)
-                    packages |= package
-                    if create_package_level: self._create_package_level(move_line_to_pack, package)
-                    if last_package:
-                        # package = self.env['stock.quant.package'].create(
-                        #    {'package_type_id': packaging.package_type_id and packaging.package_type_id.id})
-                        new_move_line = move_line_to_pack.copy({
-                            'product_uom_qty': move_line_to_pack.state == 'assigned' and last_package or 0.0,
-                            'qty_done': last_package,
-                            # 'result_package_id': package.id
-                        })
-                        remaining_qty -= last_package
-                        package = self._pack_move_line(new_move_line, packaging)
-                        packages |= package
-                        if create_package_level: self._create_package_level(new_move_line, package)
+                if self.packing_mode == 'mixed':
+                    packing_plan.extend(self._get_move_line_mixed_packing_plan(
+                        move_line_to_pack, self._get_product_packagings() | packaging))
                 else:
-                    # in this case the move line qty done is less then the contained qty
-                    # we have to do this check,because if the nbr_of_packages == 0 this mean that move line is not splitted at all because the qty_done is less then the qty contained by the package
-                    # package = self.env['stock.quant.package'].create(
-                    #    {'package_type_id': packaging.package_type_id and packaging.package_type_id.id})
-                    # move_line_to_pack.write({
-                    #    'result_package_id': package.id
-                    # })
-                    package = self._pack_move_line(move_line_to_pack, packaging)
-                    packages |= package
+                    packing_plan.extend(self._get_move_line_packing_plan(move_line_to_pack, packaging))
+        packages = self._apply_packing_plan(packing_plan, create_package_level=create_package_level)
+        if self.packing_mode == 'nested':
+            packages_by_packaging = {}
+            for packing_step, package in zip(packing_plan, packages):
+                packages_by_packaging.setdefault(packing_step[1], self.env['stock.quant.package'])
+                packages_by_packaging[packing_step[1]] |= package
+            for packaging, packaging_packages in packages_by_packaging.items():
+                self._put_in_parent_packages(packaging_packages, packaging)
+        return packages
+
+    def _get_product_packagings(self):
+        """ Return the packagings of the produced product, biggest first """
+        self.ensure_one()
+        return self.product_id.packaging_ids.filtered(
+            lambda packaging: float_compare(packaging.qty, 0.0, precision_rounding=self.product_uom_id.rounding) > 0
+        ).sorted('qty', reverse=True)
+
+    def _get_move_line_mixed_packing_plan(self, move_line, packagings):
+        """ Return the plan to split move_line in packs of packagings (see _get_move_line_packing_plan), the biggest
+        packagings are filled first and the remaining quantity goes to the smaller ones, what doesn't fill the
+        smallest packaging is put in a last incomplete pack of it """
+        plan = plan_mixed_split(move_line.qty_done, tuple((packaging.id, packaging.qty) for packaging in packagings),
+                                move_line.product_uom_id.rounding)
+        return self._get_packing_plan_steps(move_line, plan, packagings)
+
+    def _put_in_parent_packages(self, packages, packaging):
+        """ Put packages, packs of packaging, in packs of the bigger packagings of the product level by level, each
+        level being filled with as many packs of the previous level as its capacity allows """
+        parent_packagings = self._get_product_packagings().filtered(
+            lambda parent_packaging: parent_packaging.qty > packaging.qty).sorted('qty')
+        for parent_packaging in parent_packagings:
+            capacity = int(parent_packaging.qty // packaging.qty)
+            if capacity < 2 or len(packages) < 2:
+                continue
+            package_chunks = [packages[index:index + capacity] for index in range(0, len(packages), capacity)]
+            parent_packages = self.env['stock.quant.package'].create([{
+                'name': package_name,
+                'package_type_id': parent_packaging.package_type_id and parent_packaging.package_type_id.id,
+            } for package_name in self.env['stock.quant.package']._reserve_package_names(len(package_chunks))])
+            for parent_package, package_chunk in zip(parent_packages, package_chunks):
+                package_chunk.write({'parent_package_id': parent_package.id})
+            count_pack_operation('packages_created', len(parent_packages))
+            packages, packaging = parent_packages, parent_packaging
+
+    def _get_move_line_packing_plan(self, move_line, packaging):
+        """ Return the plan to split move_line according to the capacity of packaging, as a list of
+        (move line, packaging, values, to copy, create package level) tuples ordered as the packages have to be created """
+        plan = plan_packaging_split(move_line.qty_done, packaging.qty, move_line.product_uom_id.rounding, packaging.id)
+        return self._get_packing_plan_steps(move_line, plan, packaging)
+
+    def _get_packing_plan_steps(self, move_line, plan, packagings):
+        """ Expand plan, a PackingPlan of tools.packing_planner keyed by the ids of packagings, into the packing plan
+        steps of move_line applied by _apply_packing_plan, the steps of a run of packages share their values """
+        packagings_by_id = {packaging.id: packaging for packaging in packagings}
+        if not plan.split:
+            # the move line qty done is less then the contained qty, so the move line is not splitted at all
+            return [(move_line, packagings_by_id[plan.runs[0].packaging], {}, False, False)]
+        is_assigned = move_line.state == 'assigned'
+        packing_plan = []
+        for run in plan.runs:
+            packaging = packagings_by_id[run.packaging]
+            vals = {
+                'product_uom_qty': is_assigned and run.quantity or 0.0,
+                'qty_done': run.quantity,
+            }
+            packing_plan += [(move_line, packaging, vals, True, True)] * run.count
+        # the move line is kept for the package at the source index of the plan, the other ones are copies of it
+        packing_plan[plan.source_index] = packing_plan[plan.source_index][:3] + (False, True)
+        return packing_plan
+
+    def _apply_packing_plan(self, packing_plan, create_package_level=False):
+        """ Create the packages and the split move lines of packing_plan (see _get_move_line_packing_plan) with one
+        multi-record create each, the original move lines are updated in place """
+        next_sequences = {}
+        package_vals_list = []
+        for move_line, packaging, vals, to_copy, package_level in packing_plan:
+            production = move_line.move_id.production_id
+            if production not in next_sequences:
+                next_sequences[production] = production._get_next_package_sequence()
+            package_vals = self._prepare_package_vals(packaging, move_line, next_sequences[production])
+            if to_copy:
+                # the package will be linked to its move line once the move line is created
+                package_vals['production_move_line_id'] = False
+            package_vals_list.append(package_vals)
+            next_sequences[production] += 1
+        # the names are reserved as one block of the package sequence, in the order of the packages of each production
+        package_names = self.env['stock.quant.package']._reserve_package_names(len(package_vals_list))
+        for package_vals, package_name in zip(package_vals_list, package_names):
+            package_vals['name'] = package_name
+        packages = self.env['stock.quant.package'].create(package_vals_list)
+        count_pack_operation('packages_created', len(packages))
+        copy_data_by_move_line = {}
+        move_line_vals_list = []
+        packed_move_lines = []
+        for (move_line, packaging, vals, to_copy, package_level), package in zip(packing_plan, packages):
+            if to_copy:
+                if move_line not in copy_data_by_move_line:
+                    copy_data_by_move_line[move_line] = move_line.copy_data()[0]
+                # for the move lines to create we keep their index as they don't exist yet
+                packed_move_lines.append(len(move_line_vals_list))
+                move_line_vals_list.append(dict(copy_data_by_move_line[move_line], **vals, result_package_id=package.id))
+            else:
+                move_line.write(dict(vals, result_package_id=package.id))
+                packed_move_lines.append(move_line)
+        new_move_lines = self.env['stock.move.line'].create(move_line_vals_list)
+        count_pack_operation('move_lines_split', len(new_move_lines))
+        new_move_lines.result_package_id._link_production_move_line()
+        if create_package_level:
+            for packing_step, package, packed_move_line in zip(packing_plan, packages, packed_move_lines):
+                if not packing_step[4]:
+                    continue
+                if isinstance(packed_move_line, int):
+                    packed_move_line = new_move_lines[packed_move_line]
+                self._create_package_level(packed_move_line, package)
         return packages
 
+    def _prepare_package_vals(self, packaging, move_line, sequence):
+        return {
+            'package_type_id': packaging.package_type_id and packaging.package_type_id.id,
+            'production_id': move_line.move_id.production_id.id,
+            'production_move_line_id': move_line.id,
+            'production_sequence': sequence,
+        }
+
+    def _get_next_package_sequence(self):
+        self.ensure_one()
+        last_package = self.env['stock.quant.package'].search([('production_id', '=', self.id)],
+                                                               order='production_sequence DESC', limit=1)
+        return last_package.production_sequence + 1
+
     def _pack_move_line(self, move_line, packaging):
+        production = move_line.move_id.production_id
         package = self.env['stock.quant.package'].create(
-            {'package_type_id': packaging.package_type_id and packaging.package_type_id.id})
+            self._prepare_package_vals(packaging, move_line, production._get_next_package_sequence()))
+        count_pack_operation('packages_created', 1)
         move_line.write({'result_package_id': package.id})
         return package
 
     def action_refresh_packages(self):
+        if not self._lock_for_packing():
+            return self._action_notify_pack_operation_done()
         # if the packages have to be reset we don't need to refresh them
         self._check_package_reset()
-        return self._refresh_packages_with_qty_producing()
+        self._check_pack_job()
+        queued_productions = self._queue_pack_jobs('refresh')
+        (self - queued_productions)._refresh_packages_with_qty_producing()
+        if queued_productions:
+            return queued_productions._action_notify_pack_jobs()
 
     def _check_package_reset(self):
         for each in self:
             if each.packages_to_reset:
-                raise ValidationError(_("Packages of Manufacturing %s are no longer valid ,you should reset them!"))
+                raise ValidationError(_("Packages of Manufacturing %s are no longer valid ,you should reset them!")
+                                      % each.name)
 
+    @profile_pack_operation
     def _refresh_packages_with_qty_producing(self):
+        # the whole delta plan of all the orders is worked out first, then it is applied with bulk unlink, write and create
+        packages_removed, packages_updated, packages_added = self._apply_packages_delta_plans(
+            {each: each._get_packages_refresh_plan() for each in self})
+        self.move_finished_ids._action_assign()
+        self._plan_destruction_activities(packages_removed, packages_updated, packages_added)
+
+    def _apply_packages_delta_plans(self, delta_plans):
+        """ Apply the delta plans by order, as returned by _get_packages_refresh_plan, with one unlink of all the package
+        move lines and packages to remove, one write by new quantity and one bulk creation of the packages to add.
+        Return the names of the packages removed, updated and added by order id """
         packages_removed = {}
         packages_updated = {}
         packages_added = {}
-        for each in self:
-            packages_removed.update({each.id: []})
-            packages_updated.update({each.id: []})
-            packages_added.update({each.id: []})
         ml_to_remove = self.env['stock.move.line']
-        package_to_remove = self.env['stock.quant.package']
-        ml_to_update = self.env['stock.move.line']
-        ml_new_qty = {}
-        for each in self:
-            if not each.has_packages:
-                continue
-            if float_compare(each.qty_producing, each.move_finished_ids.filtered(
-                    lambda mv: mv.product_id.id == each.product_id.id).quantity_done,
-                             precision_rounding=each.product_uom_id.rounding) < 0:
-                qty_removed = 0.0
-                qty_to_remove = each.move_finished_ids.filtered(
-                    lambda mv: mv.product_id.id == each.product_id.id).quantity_done - each.qty_producing
-                packages_move_lines = each._get_related_packages_move_lines(order='result_package_id DESC')
-                for package_ml in packages_move_lines:
-                    qty_removed += package_ml.qty_done
-                    if float_compare(qty_removed, qty_to_remove, precision_rounding=each.product_uom_id.rounding) == 0:
-                        ml_to_remove |= package_ml
-                        package_to_remove |= package_ml.result_package_id
-                        break
-                    elif float_compare(qty_removed, qty_to_remove, precision_rounding=each.product_uom_id.rounding) < 0:
-                        ml_to_remove |= package_ml
-                        package_to_remove |= package_ml.result_package_id
-                    elif float_compare(qty_removed, qty_to_remove, precision_rounding=each.product_uom_id.rounding) > 0:
-                        ml_to_update |= package_ml
-                        ml_new_qty.update({package_ml.id: qty_removed - qty_to_remove})
-                        break
-            elif float_compare(each.qty_producing, each.move_finished_ids.filtered(
-                    lambda mv: mv.product_id.id == each.product_id.id).quantity_done,
-                               precision_rounding=each.product_uom_id.rounding) > 0:
-                qty_added = 0.0
-                qty_to_add = each.qty_producing - each.move_finished_ids.filtered(
-                    lambda mv: mv.product_id.id == each.product_id.id).quantity_done
-                package_move_line = each._get_related_packages_move_lines(order='result_package_id DESC', limit=1)
-                # we have to check if there is un incomplete quantity in this last package to start the adding from that
-                if float_compare(package_move_line.qty_done, each.qty_by_packaging,
-                                 precision_rounding=each.product_uom_id.rounding) < 0:
-                    ml_to_update |= package_move_line
-                    qty_to_complete_package = min(each.qty_by_packaging - package_move_line.qty_done, qty_to_add)
-                    ml_new_qty.update({package_move_line.id: package_move_line.qty_done + qty_to_complete_package})
-                    qty_added += qty_to_complete_package
-                # we have to create and add packages until we achieve the qty that should be added
-                qty_to_add -= qty_added
-                while qty_to_add:
-                    # new_package = self.env['stock.quant.package'].create(
-                    #    {'package_type_id': each.product_packaging_id.package_type_id and each.product_packaging_id.package_type_id.id})
-                    new_move_line = package_move_line.copy({
-                        'product_uom_qty': min(qty_to_add, each.qty_by_packaging),
-                        'qty_done': min(qty_to_add, each.qty_by_packaging),
-                        'move_id': package_move_line.move_id.id,
-                        # 'result_package_id': new_package.id
-                    })
-                    new_package = self._pack_move_line(new_move_line, each.product_packaging_id)
-                    packages_added[each.id].append(new_package.name)
-                    # The while condition accept the negative values as normal values so it will not break
-                    qty_to_add = max(qty_to_add - each.qty_by_packaging, 0)
-            packages_removed[each.id] = ml_to_remove.mapped("result_package_id").mapped("name")
-            packages_updated[each.id] = ml_to_update.mapped("result_package_id").mapped("name")
+        ml_to_update_by_qty = {}
+        packing_plan = []
+        for production, (order_ml_to_remove, order_ml_new_qty, order_packing_plan) in delta_plans.items():
+            ml_to_remove |= order_ml_to_remove
+            for ml, new_qty in order_ml_new_qty.items():
+                ml_to_update_by_qty.setdefault(new_qty, self.env['stock.move.line'])
+                ml_to_update_by_qty[new_qty] |= ml
+            packing_plan += order_packing_plan
+            packages_removed[production.id] = order_ml_to_remove.mapped("result_package_id").mapped("name")
+            packages_updated[production.id] = [ml.result_package_id.name for ml in order_ml_new_qty]
+            packages_added[production.id] = []
+        package_to_remove = ml_to_remove.result_package_id
         ml_to_remove.unlink()
+        count_pack_operation('packages_removed', len(package_to_remove))
         package_to_remove.unlink()
-        for ml in ml_to_update:
-            ml.update({'qty_done': ml_new_qty[ml.id], 'product_uom_qty': ml_new_qty[ml.id]})
-        self.move_finished_ids._action_assign()
-        self._plan_destruction_activities(packages_removed, packages_updated, packages_added)
+        for new_qty, ml_to_update in ml_to_update_by_qty.items():
+            ml_to_update.write({'qty_done': new_qty, 'product_uom_qty': new_qty})
+        new_packages = self._apply_packing_plan(packing_plan)
+        for new_package in new_packages:
+            packages_added[new_package.production_id.id].append(new_package.name)
+        # the allocations of the removed packages are removed with them, the ones of the packages before the first
+        # updated or added package don't change
+        changed_packages = new_packages
+        for ml_to_update in ml_to_update_by_qty.values():
+            changed_packages |= ml_to_update.result_package_id
+        for production in changed_packages.production_id:
+            production._rebuild_package_allocations(from_package_id=min(
+                changed_packages.filtered(lambda pack: pack.production_id == production).ids))
+        return packages_removed, packages_updated, packages_added
+
+    def _rebuild_package_allocations(self, from_package_id=False):
+        """ Rebuild the allocations of the packages of the orders to their linked sale orders, from the package
+        from_package_id only if given as the allocations of the packages before it don't change """
+        Allocation = self.env['mrp.production.package.allocation'].sudo()
+        stale_allocations_domain = [('production_id', 'in', self.ids)]
+        if from_package_id:
+            stale_allocations_domain.append(('package_id', '>=', from_package_id))
+        Allocation.search(stale_allocations_domain).unlink()
+        allocation_vals_list = []
+        for each in self:
+            if not getattr(each, MRP_PRODUCTION_LINKED_SALE_ORDERS_FIELD, False):
+                continue
+            packages_domain = [('production_id', '=', each.id), ('production_move_line_id.state', '=', 'assigned')]
+            packages_before_capacity = 0.0
+            sequence = 1
+            if from_package_id:
+                packages_domain.append(('id', '>=', from_package_id))
+                packages_before = self.env['stock.move.line'].read_group(
+                    [('move_id.production_id', '=', each.id), ('result_package_id', '!=', False),
+                     ('result_package_id', '<', from_package_id), ('state', '=', 'assigned')],
+                    ['product_uom_qty:sum'], [])
+                if packages_before:
+                    packages_before_capacity = packages_before[0]['product_uom_qty'] or 0.0
+                    sequence += packages_before[0]['__count']
+            packages = self.env['stock.quant.package'].search(packages_domain, order='id')
+            for package, package_data in packages._iter_production_packing_data(
+                    each, packages, packages_before_capacity=packages_before_capacity, sequence=sequence):
+                allocation_vals_list += [{
+                    'production_id': each.id,
+                    'package_id': package.id,
+                    'package_sequence': package_data['sequence'],
+                    'sale_order_id': sale_order.id,
+                    'quantity': quantity,
+                } for sale_order, quantity in package_data['allocations']]
+        Allocation.create(allocation_vals_list)
+
+    def write(self, vals):
+        res = super(MrpProduction, self).write(vals)
+        if MRP_PRODUCTION_LINKED_SALE_ORDERS_FIELD in vals:
+            self.filtered(lambda mrp: mrp.has_packages)._rebuild_package_allocations()
+        return res
+
+    def _get_packages_refresh_plan(self):
+        """ Work out in one pass how the packages have to change to follow the quantity producing, return the package
+        move lines to remove, the new quantity of the package move lines to update by move line and the packing plan
+        of the packages to add (see _get_move_line_packing_plan) """
+        self.ensure_one()
+        ml_to_remove = self.env['stock.move.line']
+        ml_new_qty = {}
+        packing_plan = []
+        if not self.has_packages:
+            return ml_to_remove, ml_new_qty, packing_plan
+        qty_delta = self.qty_producing - sum(self.move_finished_ids.filtered(
+            lambda mv: mv.product_id.id == self.product_id.id).mapped('quantity_done'))
+        package_move_lines = self.package_move_line_ids
+        plan = plan_refresh(package_move_lines.mapped('qty_done'), qty_delta, self.qty_by_packaging,
+                            self.product_uom_id.rounding)
+        return self._get_delta_plan_steps(package_move_lines, plan)
+
+    def _get_delta_plan_steps(self, package_move_lines, plan):
+        """ Turn plan, a DeltaPlan of tools.packing_planner indexed as package_move_lines, into the package move lines
+        to remove, the new quantity by package move line and the packing plan of the packages to add, copies of the
+        last package move line """
+        ml_to_remove = self.env['stock.move.line'].concat(*(package_move_lines[index] for index in plan.removals))
+        ml_new_qty = {package_move_lines[index]: qty for index, qty in plan.updates.items()}
+        packing_plan = []
+        for run in plan.additions.runs:
+            packing_plan += [(package_move_lines[-1:], self.product_packaging_id, {
+                'product_uom_qty': run.quantity,
+                'qty_done': run.quantity,
+            }, True, False)] * run.count
+        return ml_to_remove, ml_new_qty, packing_plan
 
     def _plan_destruction_activities(self, packages_removed, packages_updated, packages_added,reset_packages_message=False):
+        # the model is resolved once for all the activities, ir.model caches its ids
+        res_model_id = self.env['ir.model']._get_id(self._name)
         activities_to_create = []
+
+        def _prepare_activity_vals(production, summary, note):
+            return {
+                'res_id': production.id,
+                'res_model_id': res_model_id,
+                'user_id': self.env.user.id,
+                'summary': summary,
+                'note': note,
+                'activity_type_id': 4,
+                # 'date_deadline': datetime.date.today(),
+            }
+
         for each in self:
-            order_packages_removed = packages_removed[each.id]
-            order_packages_updated = packages_updated[each.id]
-            order_packages_added = packages_added[each.id]
+            order_packages_removed = packages_removed.get(each.id, [])
+            order_packages_updated = packages_updated.get(each.id, [])
+            order_packages_added = packages_added.get(each.id, [])
             if reset_packages_message and order_packages_removed:
-                activities_to_create.append({
-                    'res_id': each.id,
-                    'res_model_id': self.env['ir.model'].search([('model', '=', self._name)]).id,
-                    'user_id': self.env.user.id,
-                    'summary': _('Packages to destruct'),
-                    'note': _('All the packages from %s ... %s should be destructed') %(order_packages_removed[len(order_packages_removed)-1],
-                                                                                        order_packages_removed[0]),
-                    'activity_type_id': 4,
-                    # 'date_deadline': datetime.date.today(),
-                })
+                activities_to_create.append(_prepare_activity_vals(
+                    each, _('Packages to destruct'),
+                    _('All the packages from %s ... %s should be destructed') % (
+                        order_packages_removed[len(order_packages_removed)-1], order_packages_removed[0])))
                 # if we this is reset packages activity message we have to stop here
                 continue
             if order_packages_removed:
-                activities_to_create.append({
-                    'res_id': each.id,
-                    'res_model_id': self.env['ir.model'].search([('model', '=', self._name)]).id,
-                    'user_id': self.env.user.id,
-                    'summary': _('Packages to destruct'),
-                    'note': _('The packages %s should be destructed') % ",".join(
-                        pack_name for pack_name in order_packages_removed),
-                    'activity_type_id': 4,
-                    # 'date_deadline': datetime.date.today(),
-                })
+                activities_to_create.append(_prepare_activity_vals(
+                    each, _('Packages to destruct'),
+                    _('The packages %s should be destructed') % self._format_package_names(order_packages_removed)))
             if order_packages_updated:
-                activities_to_create.append({
-                    'res_id': each.id,
-                    'res_model_id': self.env['ir.model'].search([('model', '=', self._name)]).id,
-                    'user_id': self.env.user.id,
-                    'summary': _('Packages to update'),
-                    'note': _('The packages %s should be updated') % ",".join(
-                        pack_name for pack_name in order_packages_updated),
-                    'activity_type_id': 4,
-                    # 'date_deadline': datetime.date.today(),
-                })
+                activities_to_create.append(_prepare_activity_vals(
+                    each, _('Packages to update'),
+                    _('The packages %s should be updated') % self._format_package_names(order_packages_updated)))
             if order_packages_added:
-                activities_to_create.append({
-                    'res_id': each.id,
-                    'res_model_id': self.env['ir.model'].search([('model', '=', self._name)]).id,
-                    'user_id': self.env.user.id,
-                    'summary': _('Packages added'),
-                    'note': _('The packages %s have been added') % ",".join(
-                        pack_name for pack_name in order_packages_added),
-                    'activity_type_id': 4,
-                    # 'date_deadline': datetime.date.today(),
-                })
-        self.env['mail.activity'].create(activities_to_create)
+                activities_to_create.append(_prepare_activity_vals(
+                    each, _('Packages added'),
+                    _('The packages %s have been added') % self._format_package_names(order_packages_added)))
+        if activities_to_create:
+            self.env['mail.activity'].create(activities_to_create)
+
+    @api.model
+    def _format_package_names(self, package_names):
+        """ Join the package names, a long list of packages is summarised by the range of its names """
+        if len(package_names) <= PACKAGE_NAMES_DISPLAY_LIMIT:
+            return ",".join(package_names)
+        return _('%s…%s (%s packs)') % (min(package_names), max(package_names), len(package_names))
 
     def action_reset_packages(self):
-        return self._reset_packages()
+        if not self._lock_for_packing():
+            return self._action_notify_pack_operation_done()
+        self._check_pack_job()
+        queued_productions = self.filtered(lambda mrp: mrp.packages_to_reset)._queue_pack_jobs('reset')
+        (self - queued_productions)._reset_packages()
+        if queued_productions:
+            return queued_productions._action_notify_pack_jobs()
 
+    @profile_pack_operation
     def _reset_packages(self):
+        productions_to_reset = self.filtered(lambda mrp: mrp.packages_to_reset)
+        reconciled_productions = self.browse()
+        if self.env['ir.config_parameter'].sudo().get_param(RESET_PACKAGES_MODE_PARAM, 'reconcile') == 'reconcile':
+            reconciled_productions = productions_to_reset.filtered(
+                lambda mrp: mrp.packing_mode == 'packaging' and mrp.product_packaging_id)
+            reconciled_productions._reconcile_packages()
         packages_removed = {}
         packages_updated = {}
         packages_added = {}
-        for each in self.filtered(lambda mrp: mrp.packages_to_reset):
+        for each in productions_to_reset - reconciled_productions:
             packages_removed.update({each.id: []})
             packages_updated.update({each.id: []})
             packages_added.update({each.id: []})
             # remove all the packages as they are no longer valid
             packages_to_remove = each._get_related_packages()
+            # the parent packages of nested packs are no longer valid either
+            parent_packages = parent_packages_to_remove = packages_to_remove.parent_package_id
+            while parent_packages:
+                parent_packages = parent_packages.parent_package_id - parent_packages_to_remove
+                parent_packages_to_remove |= parent_packages
             each.move_finished_ids.filtered(lambda mv:mv.product_id.id == each.product_id.id)._do_unreserve()
             each.move_finished_ids.move_line_ids.unlink()
             packages_removed[each.id] = packages_to_remove.mapped("name")
+            count_pack_operation('packages_removed', len(packages_to_remove))
             packages_to_remove.unlink()
-            each.action_put_in_pack()
+            parent_packages_to_remove.unlink()
+            # the orders are already locked by the reset, its token must not skip the put in pack
+            each.with_context(pack_idempotency_token=False).action_put_in_pack()
         self._plan_destruction_activities(packages_removed, packages_updated, packages_added,reset_packages_message=True)
 
+    def _reconcile_packages(self):
+        """ Bring the packages in line with the layout a new put in pack would give, keeping the packages which already
+        match it and only removing, updating or adding the ones which differ """
+        if not self:
+            return
+        # the finished product move lines out of the packages would be counted in the done quantity
+        self.move_finished_ids.filtered(
+            lambda mv: mv.product_id == mv.production_id.product_id
+        ).move_line_ids.filtered(lambda ml: not ml.result_package_id).unlink()
+        packages_removed, packages_updated, packages_added = self._apply_packages_delta_plans(
+            {each: each._get_packages_reconcile_plan() for each in self})
+        for each in self:
+            package_type = each.product_packaging_id.package_type_id
+            packages_to_retype = each._get_related_packages().filtered(lambda pack: pack.package_type_id != package_type)
+            if packages_to_retype:
+                packages_to_retype.write({'package_type_id': package_type.id})
+                packages_updated[each.id] += [name for name in packages_to_retype.mapped('name')
+                                              if name not in packages_updated[each.id]]
+        self.move_finished_ids._action_assign()
+        # as for a full reset, a single activity asks to destruct the range of the packages removed or changed, last
+        # package first as the full reset lists them
+        packages_to_destruct = {each.id: sorted(set(packages_removed[each.id] + packages_updated[each.id]), reverse=True)
+                                for each in self}
+        self._plan_destruction_activities(packages_to_destruct, {}, {}, reset_packages_message=True)
 
-
+    def _get_packages_reconcile_plan(self):
+        """ Compare the packages with the target layout of full packages of the packaging and a last incomplete one,
+        and return the delta plan to reach it (see _get_packages_refresh_plan) """
+        self.ensure_one()
+        package_move_lines = self.package_move_line_ids.filtered(lambda ml: ml.product_id.id == self.product_id.id)
+        plan = plan_reconcile(package_move_lines.mapped('qty_done'), self.qty_producing, self.product_packaging_id.qty,
+                              self.product_uom_id.rounding, package_move_lines.mapped('product_uom_qty'))
+        return self._get_delta_plan_steps(package_move_lines, plan)
 
     def button_mark_done(self):
-        for each in self:
-            if not each.has_packages:
-                each.move_finished_ids.move_line_ids.unlink()
+        # the finished move lines of the orders without packages are set again from the producing quantity by the
+        # post inventory, only the ones which differ from what it would set are removed, at once for all the orders
+        self.filtered(lambda mrp: not mrp.has_packages)._get_finished_move_lines_to_reset().unlink()
         return super(MrpProduction, self).button_mark_done()
+
+    def _get_finished_move_lines_to_reset(self):
+        """ Return the finished move lines to remove before marking self as done: the lines of the finished product move
+        are kept when they already hold the producing quantity with the produced lot, as the post inventory would set
+        them, the lines of the by-products are always removed """
+        move_lines_to_reset = self.env['stock.move.line']
+        for each in self:
+            finished_moves = each.move_finished_ids.filtered(lambda mv: mv.state not in ('done', 'cancel'))
+            product_moves = finished_moves.filtered(lambda mv: mv.product_id == each.product_id)
+            move_lines_to_reset |= (finished_moves - product_moves).move_line_ids
+            quantity_to_produce = float_round(each.qty_producing - each.qty_produced,
+                                              precision_rounding=each.product_uom_id.rounding)
+            done_move_lines = product_moves.move_line_ids.filtered('qty_done')
+            if float_compare(sum(done_move_lines.mapped('qty_done')), quantity_to_produce,
+                             precision_rounding=each.product_uom_id.rounding) != 0 \
+                    or any(move_line.lot_id != each.lot_producing_id for move_line in done_move_lines):
+                move_lines_to_reset |= product_moves.move_line_ids
+        return move_lines_to_reset
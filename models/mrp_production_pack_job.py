@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from datetime import timedelta
+
+from psycopg2 import OperationalError, errorcodes
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError, ValidationError
+
+_logger = logging.getLogger(__name__)
+
+PACK_JOB_OPERATIONS = [
+    ('put_in_pack', 'Put in Pack'),
+    ('refresh', 'Refresh Packages'),
+    ('reset', 'Reset Packages'),
+]
+PACK_JOB_ACTIVE_STATES = ('pending', 'running')
+PACK_JOB_TIMEOUT_PARAM = 'mrp_production_packs_according_packaging.pack_job_timeout'
+# in seconds, it must be longer than the time limit of the cron workers
+PACK_JOB_TIMEOUT = 3600
+PACK_JOB_MAX_ATTEMPTS = 3
+
+
+class MrpProductionPackJob(models.Model):
+    """ Packing operations of manufacturing orders run in background as they have too many packages to be processed
+    in the user request """
+    _name = 'mrp.production.pack.job'
+    _description = 'Manufacturing Order Packing Job'
+    _order = 'id desc'
+
+    production_id = fields.Many2one('mrp.production', 'Manufacturing Order', required=True, index=True,
+                                    ondelete='cascade', readonly=True)
+    operation = fields.Selection(PACK_JOB_OPERATIONS, required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled')], default='pending', required=True, index=True, readonly=True)
+    user_id = fields.Many2one('res.users', 'Requested by', required=True, readonly=True,
+                              default=lambda self: self.env.user)
+    package_count = fields.Integer('Packages', readonly=True,
+                                   help='Estimated number of packages processed by the job')
+    date_started = fields.Datetime('Started on', readonly=True)
+    date_done = fields.Datetime('Done on', readonly=True)
+    attempt_count = fields.Integer('Attempts', readonly=True,
+                                   help='Number of times the job has been started, a job whose worker has been killed '
+                                        'is started again until it reaches the maximum number of attempts')
+    error_message = fields.Text(readonly=True)
+
+    @api.model
+    def _cron_process_pack_jobs(self, limit=10):
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        self._requeue_stale_jobs()
+        jobs = self.search([('state', '=', 'pending')], order='id', limit=limit)
+        if auto_commit:
+            # each job is run in its own transaction, so that it sees the jobs cancelled since the search
+            self.env.cr.commit()
+        for job in jobs:
+            try:
+                job._run(auto_commit=auto_commit)
+                if auto_commit:
+                    self.env.cr.commit()
+            except OperationalError as error:
+                # the job has been cancelled while it was running, its work is rolled back
+                if not auto_commit or error.pgcode not in (errorcodes.SERIALIZATION_FAILURE,
+                                                            errorcodes.LOCK_NOT_AVAILABLE):
+                    raise
+                _logger.info("Packing job %s of %s has been changed while it was running", job.operation,
+                             job.production_id.name)
+                self.env.cr.rollback()
+        if len(jobs) == limit:
+            self.env.ref('mrp_production_packs_according_packaging.ir_cron_process_pack_jobs')._trigger()
+
+    @api.model
+    def _requeue_stale_jobs(self):
+        """ The jobs running for longer than the timeout have had their worker killed, their work has been rolled back
+        so they are queued again, or failed once they have reached the maximum number of attempts """
+        timeout = int(self.env['ir.config_parameter'].sudo().get_param(PACK_JOB_TIMEOUT_PARAM, PACK_JOB_TIMEOUT))
+        stale_jobs = self.search([('state', '=', 'running'),
+                                  ('date_started', '<', fields.Datetime.now() - timedelta(seconds=timeout))])
+        jobs_to_fail = stale_jobs.filtered(lambda job: job.attempt_count >= PACK_JOB_MAX_ATTEMPTS)
+        (stale_jobs - jobs_to_fail).write({'state': 'pending'})
+        for job in jobs_to_fail:
+            _logger.warning("Packing job %s of %s timed out", job.operation, job.production_id.name)
+            job._fail(_("The job has been stopped %s times before it ended, the time limit of the background workers "
+                        "is too short to process these packages.") % job.attempt_count)
+
+    def _fail(self, error_message):
+        self.ensure_one()
+        self.write({'state': 'failed', 'date_done': fields.Datetime.now(), 'error_message': error_message})
+        # the job is lost from the manufacturing order form once failed, the requester is told by an activity
+        self.production_id.activity_schedule(
+            'mail.mail_activity_data_todo', user_id=self.user_id.id,
+            summary=_('Packing job failed'),
+            note=_('The packing job "%s" failed: %s') % (dict(PACK_JOB_OPERATIONS)[self.operation], error_message))
+
+    def action_cancel(self):
+        """ Cancel the pending or running jobs, a running job which is still processed by a worker fails to save its
+        result once cancelled and its work is rolled back """
+        self.filtered(lambda job: job.state in PACK_JOB_ACTIVE_STATES).write({
+            'state': 'cancelled', 'date_done': fields.Datetime.now()})
+
+    def _lock_pending(self):
+        """ Lock the job row and return whether the job is still pending, a job cancelled since it has been queued or
+        taken by another worker is not run """
+        self.ensure_one()
+        self.flush(['state'])
+        self.env.cr.execute("SELECT state FROM mrp_production_pack_job WHERE id = %s FOR UPDATE SKIP LOCKED",
+                            (self.id,))
+        row = self.env.cr.fetchone()
+        self.invalidate_cache(['state'], self.ids)
+        return bool(row) and row[0] == 'pending'
+
+    def _run(self, auto_commit=False):
+        self.ensure_one()
+        if not self._lock_pending():
+            return
+        self.write({'state': 'running', 'date_started': fields.Datetime.now(),
+                    'attempt_count': self.attempt_count + 1})
+        if auto_commit:
+            # the manufacturing order form shows the job as running while it is processed
+            self.env.cr.commit()
+        production = self.production_id.with_user(self.user_id).with_context(pack_job_running=True)
+        try:
+            with self.env.cr.savepoint():
+                if self.operation == 'put_in_pack':
+                    packages = production.action_put_in_pack() or self.env['stock.quant.package']
+                    production._plan_destruction_activities({production.id: []}, {production.id: []},
+                                                            {production.id: packages.mapped('name')})
+                elif self.operation == 'refresh':
+                    production._refresh_packages_with_qty_producing()
+                else:
+                    production._reset_packages()
+            self.write({'state': 'done', 'date_done': fields.Datetime.now()})
+        except (UserError, ValidationError) as error:
+            self.invalidate_cache()
+            self._fail(error.args[0])
+        except Exception as error:
+            _logger.exception("Packing job %s of %s failed", self.operation, self.production_id.name)
+            self.invalidate_cache()
+            self._fail(str(error))
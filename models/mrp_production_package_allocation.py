@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields
+
+
+class MrpProductionPackageAllocation(models.Model):
+    """ Quantities of the packages of manufacturing orders allocated to the sale orders linked to the orders, a package
+    spanning two sale orders has an allocation for each of them """
+    _name = 'mrp.production.package.allocation'
+    _description = 'Manufacturing Order Package Allocation'
+    _order = 'production_id, package_sequence, id'
+
+    production_id = fields.Many2one('mrp.production', 'Manufacturing Order', required=True, index=True,
+                                    ondelete='cascade')
+    package_id = fields.Many2one('stock.quant.package', 'Package', required=True, index=True, ondelete='cascade')
+    package_sequence = fields.Integer('Package Sequence')
+    sale_order_id = fields.Many2one('sale.order', 'Sale Order', required=True, index=True, ondelete='cascade')
+    quantity = fields.Float('Quantity', digits='Product Unit of Measure')
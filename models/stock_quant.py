@@ -3,35 +3,118 @@
 from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError, UserError
 from odoo.tools import float_compare, float_round, float_is_zero, format_datetime
+from odoo.tools.sql import create_index
+
+from ..tools.pack_profiling import profile_pack_operation
 
 MRP_PRODUCTION_LINKED_SALE_ORDERS_FIELD = 'sale_order_line_ids'
+PACKAGE_SEQUENCE_CODE = 'stock.quant.package'
 
 
 class QuantPackage(models.Model):
     """ Inherit stock package to constraint one product by package """
     _inherit = "stock.quant.package"
 
+    production_id = fields.Many2one(
+        'mrp.production', 'Manufacturing Order', index=True, readonly=True, copy=False,
+        help='Manufacturing order whose finished products have been put in this package')
+    production_move_line_id = fields.Many2one(
+        'stock.move.line', 'Finished Move Line', index=True, readonly=True, copy=False,
+        help='Finished move line of the manufacturing order put in this package')
+    production_sequence = fields.Integer('Sequence in Manufacturing Order', readonly=True, copy=False)
+    parent_package_id = fields.Many2one(
+        'stock.quant.package', 'Parent Package', index=True, copy=False, ondelete='set null',
+        help='Package containing this package, as a pallet containing cartons')
+    child_package_ids = fields.One2many('stock.quant.package', 'parent_package_id', 'Contained Packages')
+    sale_order_allocation_ids = fields.One2many('mrp.production.package.allocation', 'package_id',
+                                                'Sale Order Allocations')
+
+    def init(self):
+        super(QuantPackage, self).init()
+        create_index(self._cr, 'stock_quant_package_production_sequence_index', self._table,
+                     ['production_id', 'production_sequence'])
+
+    def _link_production_move_line(self):
+        """ Link the packages to the finished move lines put in them, with one query for all the packages """
+        if not self:
+            return
+        self.env['stock.move.line'].flush(['result_package_id'])
+        self.flush(['production_move_line_id'])
+        self.env.cr.execute("""
+            UPDATE stock_quant_package package
+               SET production_move_line_id = move_line.id
+              FROM stock_move_line move_line
+             WHERE move_line.result_package_id = package.id
+               AND package.id IN %s
+        """, (tuple(self.ids),))
+        self.invalidate_cache(['production_move_line_id'], self.ids)
+
+    @api.model
+    def _reserve_package_names(self, count):
+        """ Reserve count names of the package sequence with one sequence operation instead of one call of the sequence
+        by package, the names are returned in the order of the sequence. They are only consecutive for no gap
+        sequences, the numbers of a standard sequence can be interleaved with the ones drawn by concurrent
+        transactions """
+        if count <= 0:
+            return []
+        sequence = self.env['ir.sequence'].search([('code', '=', PACKAGE_SEQUENCE_CODE),
+                                                   ('company_id', 'in', [self.env.company.id, False])],
+                                                  order='company_id', limit=1)
+        if not sequence or sequence.use_date_range:
+            # the numbers of the date range sequences are held by their date ranges, they are drawn one by one
+            return [self.env['ir.sequence'].next_by_code(PACKAGE_SEQUENCE_CODE) or _('Unknown Pack')
+                    for index in range(count)]
+        if sequence.implementation == 'standard':
+            # the increment of the sequence is the one of its postgres sequence, the numbers are ordered but other
+            # transactions may draw numbers between them
+            self.env.cr.execute("SELECT nextval(%s) FROM generate_series(1, %s) ORDER BY 1",
+                                ('ir_sequence_%03d' % sequence.id, count))
+            numbers = [row[0] for row in self.env.cr.fetchall()]
+        else:
+            # the no gap sequence row is locked and moved forward by the whole block at once
+            number_next = sequence._update_nogap(sequence.number_increment * count)
+            numbers = [number_next + index * sequence.number_increment for index in range(count)]
+        prefix, suffix = sequence._get_prefix_suffix()
+        return ['%s%0*d%s' % (prefix, sequence.padding, number, suffix) for number in numbers]
+
     def _get_forecasted_content(self):
         self.ensure_one()
-        finished_move_line = self._get_current_linked_move_line()
-        if not finished_move_line:
-            return False
-        sale_order_qty_tuple = self._get_sale_order()
-        if sale_order_qty_tuple:
-            origin_sale_order = sale_order_qty_tuple[0]
-            forecasted_quantity = sale_order_qty_tuple[1]
-        else:
-            origin_sale_order = self.env['sale.order']
-            forecasted_quantity = self._get_forecasted_quantity()
-        return {
-            'name': finished_move_line.result_package_id.name,
-            'lot_id': finished_move_line.move_id.production_id.lot_producing_id,
-            'partner_id': finished_move_line.product_id.partner_id,
-            'product_id': finished_move_line.product_id,
-            'prepress_proof_id': finished_move_line.move_id.production_id.prepress_proof_id,
-            'quantity': forecasted_quantity,
-            'sale_order': origin_sale_order
-        }
+        return self._get_forecasted_contents()[self.id]
+
+    @profile_pack_operation
+    def _get_forecasted_contents(self):
+        """ Batch version of _get_forecasted_content: return the forecasted content of each package of self by id """
+        # the first allocation of each package gives its sale order and its forecasted quantity, all the allocations
+        # are returned too as a package can be shared by several sale orders
+        allocations_by_package = self._get_sale_order_allocations()
+        forecasted_contents = {}
+        for package in self:
+            finished_move_line = package._get_current_linked_move_line()
+            if not finished_move_line:
+                forecasted_contents[package.id] = False
+                continue
+            forecasted_contents[package.id] = {
+                'name': finished_move_line.result_package_id.name,
+                'lot_id': finished_move_line.move_id.production_id.lot_producing_id,
+                'partner_id': finished_move_line.product_id.partner_id,
+                'product_id': finished_move_line.product_id,
+                'prepress_proof_id': finished_move_line.move_id.production_id.prepress_proof_id,
+                'quantity': package.id in allocations_by_package and allocations_by_package[package.id][0][1]
+                            or finished_move_line.product_uom_qty,
+                'sale_order': package.id in allocations_by_package
+                              and allocations_by_package[package.id][0][0] or self.env['sale.order'],
+                'allocations': allocations_by_package.get(package.id, []),
+            }
+        return forecasted_contents
+
+    def _get_sale_order_allocations(self):
+        """ Return by package id the (sale order, quantity) allocated to the packages of self, in their order, read from
+        the allocation table with one search on its package index """
+        allocations_by_package = {}
+        for allocation in self.env['mrp.production.package.allocation'].search([('package_id', 'in', self.ids)]):
+            allocations_by_package.setdefault(allocation.package_id.id, []).append(
+                (allocation.sale_order_id, allocation.quantity))
+        return allocations_by_package
 
     def _get_forecasted_quantity(self):
         self.ensure_one()
@@ -41,50 +124,108 @@ class QuantPackage(models.Model):
         return finished_move_line.product_uom_qty
 
     def _get_current_linked_move_line(self):
-        domain = [('move_id.production_id', '!=', False), ('result_package_id', '=', self.id),
-                  ('state', '=', 'assigned')]
-        return self.env['stock.move.line'].search(domain, limit=1)
+        self.ensure_one()
+        return self.production_move_line_id.filtered(lambda ml: ml.state == 'assigned')
 
     def _get_sibling_packages(self, before=False, after=False):
         self.ensure_one()
         finished_move_line = self._get_current_linked_move_line()
-        if not finished_move_line or not finished_move_line.move_id.production_id:
-            return self.env['stock.move.line']
-        domain = [('move_id.production_id', '=', finished_move_line.move_id.production_id.id),
-                  ('result_package_id', '!=', self.id),
-                  ('state', '=', 'assigned')]
+        if not finished_move_line or not self.production_id:
+            return self.env['stock.quant.package']
+        domain = [('production_id', '=', self.production_id.id),
+                  ('id', '!=', self.id),
+                  ('production_move_line_id.state', '=', 'assigned')]
         if before:
-            domain.append(('result_package_id', '<', self.id))
+            domain.append(('id', '<', self.id))
         elif after:
-            domain.append(('result_package_id', '>', self.id))
-        sibling_packages = self.env['stock.move.line'].search(domain).mapped("result_package_id")
+            domain.append(('id', '>', self.id))
+        sibling_packages = self.search(domain, order='id')
         return sibling_packages
 
     def _get_sequence_in_production(self):
+        """ Return the position of the package among the packages of its manufacturing order, counted on the
+        (production_id, production_sequence) index, see _get_production_packing_data to get it for many packages """
         self.ensure_one()
-        packages_before = self._get_sibling_packages()
-        pack_sequence = len(packages_before) + 1
-        return pack_sequence
+        if not self._get_current_linked_move_line() or not self.production_id:
+            return 1
+        return self.search_count([('production_id', '=', self.production_id.id),
+                                  ('production_sequence', '<=', self.production_sequence),
+                                  ('production_move_line_id.state', '=', 'assigned')])
 
     def _get_sale_order(self):
         self.ensure_one()
-        finished_move_line = self._get_current_linked_move_line()
-        if not finished_move_line:
+        if not self._get_current_linked_move_line():
             return False
-        if not getattr(finished_move_line.move_id.production_id, MRP_PRODUCTION_LINKED_SALE_ORDERS_FIELD):
+        allocation = self.sale_order_allocation_ids[:1]
+        if not allocation:
             return False
-        packages_before_capacity = sum(
-            sibling_package._get_current_linked_move_line().product_uom_qty for sibling_package in
-            self._get_sibling_packages(before=True))
-        total_allocated_qty = 0
-        for sale_order_link_line in getattr(finished_move_line.move_id.production_id,
-                                            MRP_PRODUCTION_LINKED_SALE_ORDERS_FIELD):
-            total_allocated_qty += sale_order_link_line.qty_producing_allocated
-            if float_compare(total_allocated_qty, packages_before_capacity,
-                             precision_rounding=finished_move_line.move_id.production_id.product_uom_id.rounding) > 0:
-                if packages_before_capacity+self._get_forecasted_quantity() > total_allocated_qty:
-                    contained_qty = total_allocated_qty % packages_before_capacity
-                else:
-                    contained_qty = self._get_forecasted_quantity()
-                return (sale_order_link_line.sale_order_id,contained_qty)
-        return False
+        return (allocation.sale_order_id, allocation.quantity)
+
+    @profile_pack_operation
+    def _get_production_packing_data(self):
+        """ Return by package id the sequence of each package of self in its manufacturing order, its forecasted quantity
+        and the sale order allocated to it (False if none). The sequences come from one ordered search of the package
+        ids of each manufacturing order instead of searching the sibling packages of each package, the allocations are
+        read from the allocation table which is kept up to date by the packing operations """
+        packing_data = {package.id: {'sequence': 1, 'quantity': 0.0, 'sale_order': False, 'allocations': []}
+                        for package in self}
+        # the packages keep the prefetching of self
+        packages_by_id = {package.id: package for package in self}
+        allocations_by_package = self._get_sale_order_allocations()
+        for production in self.production_id:
+            production_package_ids = self.search([('production_id', '=', production.id),
+                                                  ('production_move_line_id.state', '=', 'assigned')], order='id').ids
+            for sequence, package_id in enumerate(production_package_ids, 1):
+                if package_id not in packing_data:
+                    continue
+                allocations = allocations_by_package.get(package_id, [])
+                packing_data[package_id] = {
+                    'sequence': sequence,
+                    'quantity': allocations and allocations[0][1]
+                                or packages_by_id[package_id].production_move_line_id.product_uom_qty,
+                    'sale_order': allocations and allocations[0][0] or False,
+                    'allocations': allocations,
+                }
+        return packing_data
+
+    @api.model
+    def _iter_production_packing_data(self, production, packages, packages_before_capacity=0.0, sequence=1):
+        """ Walk packages, the packages of production ordered by id, and yield each package with its sequence, its
+        forecasted quantity, its allocations as (sale order, quantity) and its first allocated sale order, the
+        allocations of sale_order_line_ids are consumed in the same order so that the whole walk is linear. The walk
+        can start after the first packages given their capacity and the sequence of the first package walked. It is
+        only used to build the allocation table, the readers of the allocations read the table """
+        rounding = production.product_uom_id.rounding
+        sale_order_link_lines = iter(getattr(production, MRP_PRODUCTION_LINKED_SALE_ORDERS_FIELD, []))
+        sale_order_link_line = False
+        # the range of quantities allocated to the current sale order link line
+        allocated_start = allocated_end = 0.0
+        for sequence, package in enumerate(packages, sequence):
+            forecasted_quantity = package.production_move_line_id.product_uom_qty
+            package_end = packages_before_capacity + forecasted_quantity
+            allocations = []
+            while True:
+                # the link lines allocated before the package can not be allocated to the next packages either
+                if not sale_order_link_line or float_compare(allocated_end, packages_before_capacity,
+                                                             precision_rounding=rounding) <= 0:
+                    sale_order_link_line = next(sale_order_link_lines, False)
+                    if not sale_order_link_line:
+                        break
+                    allocated_start = allocated_end
+                    allocated_end += sale_order_link_line.qty_producing_allocated
+                    continue
+                allocated_qty = min(allocated_end, package_end) - max(allocated_start, packages_before_capacity)
+                if float_compare(allocated_qty, 0.0, precision_rounding=rounding) > 0:
+                    allocations.append((sale_order_link_line.sale_order_id, allocated_qty))
+                if float_compare(allocated_end, package_end, precision_rounding=rounding) > 0:
+                    # the link line goes on in the next package
+                    break
+                # the link line ends in this package, the next one may be allocated to it too
+                sale_order_link_line = False
+            yield package, {
+                'sequence': sequence,
+                'quantity': allocations and allocations[0][1] or forecasted_quantity,
+                'sale_order': allocations and allocations[0][0] or False,
+                'allocations': allocations,
+            }
+            packages_before_capacity = package_end
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+from . import mrp_production_packaging_report
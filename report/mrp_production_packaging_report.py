@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, tools, _
+from odoo.exceptions import UserError
+
+
+class MrpProductionPackagingReport(models.Model):
+    """ Packing progress of the manufacturing orders, aggregated from their packed finished move lines in one grouped
+    query """
+    _name = 'mrp.production.packaging.report'
+    _description = 'Manufacturing Order Packaging Statistics'
+    _auto = False
+    _rec_name = 'production_id'
+    _order = 'date_planned_start desc'
+
+    production_id = fields.Many2one('mrp.production', 'Manufacturing Order', readonly=True)
+    product_id = fields.Many2one('product.product', 'Product', readonly=True)
+    product_packaging_id = fields.Many2one('product.packaging', 'Packaging', readonly=True)
+    packing_mode = fields.Selection([
+        ('packaging', 'Selected Packaging'),
+        ('mixed', 'All Packagings'),
+        ('nested', 'Nested Packagings')], string='Packing Mode', readonly=True)
+    company_id = fields.Many2one('res.company', 'Company', readonly=True)
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('confirmed', 'Confirmed'),
+        ('progress', 'In Progress'),
+        ('to_close', 'To Close'),
+        ('done', 'Done'),
+        ('cancel', 'Cancelled')], string='State', readonly=True)
+    date_planned_start = fields.Datetime('Scheduled Date', readonly=True)
+    qty_producing = fields.Float('Quantity Producing', digits='Product Unit of Measure', readonly=True)
+    packed_qty = fields.Float('Packed Quantity', digits='Product Unit of Measure', readonly=True)
+    package_count = fields.Integer('Packages', readonly=True)
+    full_package_count = fields.Integer('Full Packages', readonly=True)
+    incomplete_package_count = fields.Integer('Incomplete Packages', readonly=True)
+    # the flags are the ones of the manufacturing orders, so that the report always agrees with their buttons
+    packages_to_refresh = fields.Boolean('Packages To Refresh', compute='_compute_production_flags',
+                                         search='_search_packages_to_refresh')
+    packages_to_reset = fields.Boolean('Packages To Reset', compute='_compute_production_flags',
+                                       search='_search_packages_to_reset')
+
+    def _compute_production_flags(self):
+        for each in self:
+            each.packages_to_refresh = each.production_id.packages_to_refresh
+            each.packages_to_reset = each.production_id.packages_to_reset
+
+    def _search_packages_to_refresh(self, operator, value):
+        return self._search_production_flag('packages_to_refresh', operator, value)
+
+    def _search_packages_to_reset(self, operator, value):
+        return self._search_production_flag('packages_to_reset', operator, value)
+
+    def _search_production_flag(self, flag, operator, value):
+        if operator not in ('=', '!='):
+            raise UserError(_('Operation not supported'))
+        # only the orders with packages can have their packages to refresh or reset
+        productions = self.search([('package_count', '>', 0)]).production_id
+        flagged_productions = productions.filtered(flag)
+        if (operator == '=') == bool(value):
+            return [('id', 'in', flagged_productions.ids)]
+        return [('id', 'not in', flagged_productions.ids)]
+
+    def init(self):
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        self.env.cr.execute("""
+            CREATE OR REPLACE VIEW %s AS (
+                SELECT production.id AS id,
+                       production.id AS production_id,
+                       production.product_id,
+                       production.product_packaging_id,
+                       production.packing_mode,
+                       production.company_id,
+                       production.state,
+                       production.date_planned_start,
+                       production.qty_producing,
+                       COALESCE(packs.packed_qty, 0.0) AS packed_qty,
+                       COALESCE(packs.package_count, 0) AS package_count,
+                       COALESCE(packs.full_package_count, 0) AS full_package_count,
+                       COALESCE(packs.package_count, 0) - COALESCE(packs.full_package_count, 0)
+                           AS incomplete_package_count
+                  FROM mrp_production production
+             LEFT JOIN (
+                    SELECT move.production_id,
+                           SUM(move_line.qty_done) AS packed_qty,
+                           COUNT(DISTINCT move_line.result_package_id) AS package_count,
+                           COUNT(DISTINCT move_line.result_package_id)
+                               FILTER (WHERE move_line.qty_done >= move_packaging.qty) AS full_package_count
+                      FROM stock_move_line move_line
+                      JOIN stock_move move ON move.id = move_line.move_id
+                      JOIN mrp_production move_production ON move_production.id = move.production_id
+                                                         AND move_production.product_id = move.product_id
+                      -- the packs of all the packagings are full but the last one which is a pack of the smallest
+                      -- packaging, the packs of the other modes are packs of the selected packaging
+                 LEFT JOIN LATERAL (
+                        SELECT CASE WHEN move_production.packing_mode = 'mixed'
+                                    THEN (SELECT MIN(product_packaging.qty)
+                                            FROM product_packaging
+                                           WHERE product_packaging.product_id = move.product_id
+                                             AND product_packaging.qty > 0)
+                                    ELSE (SELECT product_packaging.qty
+                                            FROM product_packaging
+                                           WHERE product_packaging.id = move_production.product_packaging_id)
+                               END AS qty
+                        ) move_packaging ON TRUE
+                     WHERE move_line.result_package_id IS NOT NULL
+                  GROUP BY move.production_id
+                  ) packs ON packs.production_id = production.id
+                 WHERE production.product_packaging_id IS NOT NULL
+            )
+        """ % self._table)
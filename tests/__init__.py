@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+from . import test_packing_planner
+from . import test_put_in_pack
+from . import test_packaging
+from . import test_packaging_query_count
+from . import test_pack_job
+from . import test_packing_modes
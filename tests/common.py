@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests.common import Form, TransactionCase
+
+from odoo.addons.mrp_production_packs_according_packaging.models.mrp_production import ASYNC_PACK_THRESHOLD_PARAM
+from odoo.addons.mrp_production_packs_according_packaging.models.stock_quant import (
+    MRP_PRODUCTION_LINKED_SALE_ORDERS_FIELD)
+
+
+class TestMrpProductionPacksCommon(TransactionCase):
+    """ Fixture generators of manufacturing orders to put in pack """
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestMrpProductionPacksCommon, cls).setUpClass()
+        cls.env.user.groups_id += cls.env.ref('stock.group_tracking_lot')
+        # the packing operations are run in the test transaction, never queued as background jobs
+        cls.env['ir.config_parameter'].sudo().set_param(ASYNC_PACK_THRESHOLD_PARAM, 0)
+        cls.uom_unit = cls.env.ref('uom.product_uom_unit')
+        cls.package_type = cls.env['stock.package.type'].create({'name': 'Box'})
+        cls.product = cls.env['product.product'].create({
+            'name': 'Packed Product',
+            'type': 'product',
+            'uom_id': cls.uom_unit.id,
+            'uom_po_id': cls.uom_unit.id,
+        })
+        cls.component = cls.env['product.product'].create({'name': 'Component', 'type': 'consu'})
+        cls.byproducts = cls.env['product.product'].create([{
+            'name': 'By-Product %s' % index,
+            'type': 'product',
+            'uom_id': cls.uom_unit.id,
+            'uom_po_id': cls.uom_unit.id,
+        } for index in range(1, 3)])
+        cls.partner = cls.env['res.partner'].create({'name': 'Customer'})
+
+    @classmethod
+    def _create_packaging(cls, qty, product=None, package_type=None):
+        product = product or cls.product
+        return cls.env['product.packaging'].create({
+            'name': 'Pack of %s' % qty,
+            'product_id': product.id,
+            'qty': qty,
+            'package_type_id': (package_type or cls.package_type).id,
+        })
+
+    @classmethod
+    def _create_bom(cls, product=None, byproduct_count=0):
+        """ Return a bill of materials of product, its by-products give the manufacturing orders as many more finished
+        moves """
+        product = product or cls.product
+        return cls.env['mrp.bom'].create({
+            'product_tmpl_id': product.product_tmpl_id.id,
+            'product_qty': 1.0,
+            'type': 'normal',
+            'bom_line_ids': [(0, 0, {'product_id': cls.component.id, 'product_qty': 1.0})],
+            'byproduct_ids': [(0, 0, {
+                'product_id': byproduct.id,
+                'product_qty': 1.0,
+                'product_uom_id': cls.uom_unit.id,
+            }) for byproduct in cls.byproducts[:byproduct_count]],
+        })
+
+    @classmethod
+    def _create_production(cls, package_count, packaging_qty=10.0, remainder=0.0, packaging=None, bom=None,
+                           packing_mode='packaging', byproduct_count=0):
+        """ Return a confirmed manufacturing order producing package_count full packages of packaging_qty and a last
+        package of remainder, with byproduct_count more finished moves """
+        packaging = packaging or cls._create_packaging(packaging_qty)
+        bom = bom or cls._create_bom(byproduct_count=byproduct_count)
+        quantity = package_count * packaging.qty + remainder
+        production_form = Form(cls.env['mrp.production'])
+        production_form.product_id = bom.product_tmpl_id.product_variant_id
+        production_form.bom_id = bom
+        production_form.product_qty = quantity
+        production = production_form.save()
+        production.write({'product_packaging_id': packaging.id, 'packing_mode': packing_mode})
+        production.move_finished_ids.filtered(
+            lambda move: move.product_id == production.product_id).product_packaging_id = packaging
+        production.action_confirm()
+        production.qty_producing = quantity
+        return production
+
+    @classmethod
+    def _link_sale_orders(cls, production, quantities):
+        """ Allocate the quantities of production to as many new sale orders, in their order, return the sale orders """
+        sale_orders = cls.env['sale.order'].create([{'partner_id': cls.partner.id} for quantity in quantities])
+        production.write({MRP_PRODUCTION_LINKED_SALE_ORDERS_FIELD: [(0, 0, {
+            'sale_order_id': sale_order.id,
+            'qty_producing_allocated': quantity,
+        }) for sale_order, quantity in zip(sale_orders, quantities)]})
+        return sale_orders
+
+    def _get_package_layout(self, production):
+        """ Return the (qty done, reserved quantity, package type) of each package of production in their order """
+        return [(move_line.qty_done, move_line.product_uom_qty, move_line.result_package_id.package_type_id)
+                for move_line in self._get_package_move_lines(production)]
+
+    def _get_package_move_lines(self, production):
+        return production.move_finished_ids.move_line_ids.filtered(
+            lambda ml: ml.result_package_id and ml.product_id == production.product_id
+        ).sorted(lambda ml: ml.result_package_id.id)
+
+    def _get_quantities(self, production):
+        return self._get_package_move_lines(production).mapped('qty_done')
+
+    def _get_destruction_activities(self, production):
+        return self.env['mail.activity'].search([('res_model', '=', 'mrp.production'), ('res_id', '=', production.id),
+                                                 ('summary', '=', 'Packages to destruct')])
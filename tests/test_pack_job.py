@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests.common import tagged
+
+from odoo.addons.mrp_production_packs_according_packaging.models.mrp_production import ASYNC_PACK_THRESHOLD_PARAM
+from .common import TestMrpProductionPacksCommon
+
+
+@tagged('post_install', '-at_install')
+class TestPackJob(TestMrpProductionPacksCommon):
+
+    def setUp(self):
+        super(TestPackJob, self).setUp()
+        # the orders of more than 2 packs are put in pack in background
+        self.env['ir.config_parameter'].sudo().set_param(ASYNC_PACK_THRESHOLD_PARAM, 2)
+
+    def test_job_is_run(self):
+        production = self._create_production(3, remainder=4.0)
+        production.action_put_in_pack()
+        job = production.pack_job_ids
+        self.assertEqual(job.state, 'pending')
+        self.assertFalse(production._get_related_packages())
+        self.env['mrp.production.pack.job']._cron_process_pack_jobs()
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(self._get_quantities(production), [10.0, 10.0, 10.0, 4.0])
+
+    def test_cancelled_job_is_not_run(self):
+        production = self._create_production(3, remainder=4.0)
+        production.action_put_in_pack()
+        job = production.pack_job_ids
+        job.action_cancel()
+        self.env['mrp.production.pack.job']._cron_process_pack_jobs()
+        self.assertEqual(job.state, 'cancelled')
+        self.assertFalse(job.date_started)
+        self.assertFalse(production._get_related_packages())
+        # the job being cancelled, the order can be put in pack again
+        production.invalidate_cache()
+        self.assertFalse(production.pack_job_state)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.exceptions import UserError, ValidationError
+from odoo.tests.common import tagged
+
+from odoo.addons.mrp_production_packs_according_packaging.models.mrp_production import (
+    ASYNC_PACK_THRESHOLD_PARAM, PUT_IN_PACK_BATCH_SIZE_PARAM, RESET_PACKAGES_MODE_PARAM)
+from .common import TestMrpProductionPacksCommon
+
+
+@tagged('post_install', '-at_install')
+class TestPackaging(TestMrpProductionPacksCommon):
+
+    def test_put_in_pack_with_byproducts(self):
+        production = self._create_production(3, remainder=4.0, byproduct_count=2)
+        self.assertEqual(len(production.move_finished_ids), 3)
+        packages = production.action_put_in_pack()
+        self.assertEqual(self._get_quantities(production), [10.0, 10.0, 10.0, 4.0])
+        self.assertEqual(len(packages), 4)
+        self.assertEqual(packages.package_type_id, self.package_type)
+        # the by-products are not packed
+        self.assertFalse(production.move_finished_ids.filtered(
+            lambda move: move.product_id in self.byproducts).move_line_ids.result_package_id)
+        production.invalidate_cache()
+        self.assertTrue(production.has_packages)
+        self.assertEqual(production.package_count, 4)
+        self.assertEqual(production.incomplete_package_count, 1)
+        self.assertFalse(production.packages_to_refresh)
+        self.assertFalse(production.packages_to_reset)
+
+    def test_refresh_up_in_last_package(self):
+        production = self._create_production(3, remainder=4.0)
+        packages = production.action_put_in_pack()
+        production.qty_producing = 37.0
+        self.assertTrue(production.packages_to_refresh)
+        production.action_refresh_packages()
+        self.assertEqual(self._get_quantities(production), [10.0, 10.0, 10.0, 7.0])
+        self.assertEqual(production._get_related_packages(), packages.sorted('id', reverse=True))
+
+    def test_refresh_down_in_last_package(self):
+        production = self._create_production(3, remainder=4.0)
+        production.action_put_in_pack()
+        production.qty_producing = 32.0
+        production.action_refresh_packages()
+        self.assertEqual(self._get_quantities(production), [10.0, 10.0, 10.0, 2.0])
+
+    def test_refresh_up_adds_packages(self):
+        production = self._create_production(2, remainder=5.0)
+        packages = production.action_put_in_pack()
+        production.qty_producing = 47.0
+        production._refresh_packages_with_qty_producing()
+        self.assertEqual(self._get_quantities(production), [10.0, 10.0, 10.0, 10.0, 7.0])
+        # the existing packages are kept, the last one is topped up
+        self.assertEqual(self._get_package_move_lines(production)[:3].result_package_id, packages)
+        self.assertEqual(self._get_package_move_lines(production)[3:].result_package_id.mapped('production_sequence'),
+                         [4, 5])
+        self.assertFalse(production.packages_to_refresh)
+
+    def test_refresh_down_removes_packages(self):
+        production = self._create_production(2, remainder=5.0)
+        packages = production.action_put_in_pack().sorted('id')
+        production.qty_producing = 12.0
+        production._refresh_packages_with_qty_producing()
+        self.assertEqual(self._get_quantities(production), [10.0, 2.0])
+        self.assertFalse(packages[2].exists())
+        self.assertTrue(self._get_destruction_activities(production))
+
+    def test_reset_reconciles_packages(self):
+        production = self._create_production(2, remainder=5.0)
+        packages = production.action_put_in_pack().sorted('id')
+        production.qty_producing = 45.0
+        production.invalidate_cache(['packages_to_reset'])
+        self.assertTrue(production.packages_to_reset)
+        production.action_reset_packages()
+        self.assertEqual(self._get_quantities(production), [10.0, 10.0, 10.0, 10.0, 5.0])
+        # only the incomplete package is changed, the full ones are kept
+        self.assertEqual(self._get_package_move_lines(production)[:3].result_package_id, packages)
+        activity = self._get_destruction_activities(production)
+        self.assertEqual(len(activity), 1)
+        self.assertIn(packages[2].name, activity.note)
+        production.invalidate_cache()
+        self.assertFalse(production.packages_to_reset)
+
+    def test_reset_full(self):
+        self.env['ir.config_parameter'].sudo().set_param(RESET_PACKAGES_MODE_PARAM, 'full')
+        production = self._create_production(2, remainder=5.0)
+        packages = production.action_put_in_pack()
+        production.qty_producing = 45.0
+        production.invalidate_cache(['packages_to_reset'])
+        production.action_reset_packages()
+        self.assertEqual(self._get_quantities(production), [10.0, 10.0, 10.0, 10.0, 5.0])
+        self.assertFalse(packages.exists())
+        self.assertEqual(len(self._get_destruction_activities(production)), 1)
+
+    def test_forecast_and_sale_order_allocations(self):
+        production = self._create_production(2, remainder=5.0)
+        sale_order_1, sale_order_2 = self._link_sale_orders(production, [12.0, 13.0])
+        packages = production.action_put_in_pack().sorted('id')
+        packing_data = packages._get_production_packing_data()
+        self.assertEqual([packing_data[package.id]['sequence'] for package in packages], [1, 2, 3])
+        self.assertEqual([packing_data[package.id]['allocations'] for package in packages], [
+            [(sale_order_1, 10.0)],
+            [(sale_order_1, 2.0), (sale_order_2, 8.0)],
+            [(sale_order_2, 5.0)],
+        ])
+        # the single package methods agree with the batch API
+        self.assertEqual([package._get_sequence_in_production() for package in packages], [1, 2, 3])
+        self.assertEqual([package._get_sale_order() for package in packages], [
+            (sale_order_1, 10.0), (sale_order_1, 2.0), (sale_order_2, 5.0)])
+        forecasted_contents = packages._get_forecasted_contents()
+        self.assertEqual(forecasted_contents[packages[1].id]['allocations'],
+                         [(sale_order_1, 2.0), (sale_order_2, 8.0)])
+        self.assertEqual(forecasted_contents[packages[1].id]['sale_order'], sale_order_1)
+        self.assertEqual(forecasted_contents[packages[2].id]['quantity'], 5.0)
+        # the package shared by the two sale orders has a label for each of them
+        labels = list(production._iter_package_labels(chunk_size=2))
+        self.assertEqual([(label['name'], label['sale_order'], label['quantity']) for label in labels], [
+            (packages[0].name, sale_order_1.name, 10.0),
+            (packages[1].name, sale_order_1.name, 2.0),
+            (packages[1].name, sale_order_2.name, 8.0),
+            (packages[2].name, sale_order_2.name, 5.0),
+        ])
+        # the allocation table is the only source of the allocations read
+        allocation = self.env['mrp.production.package.allocation'].search([('package_id', '=', packages[2].id)])
+        allocation.quantity = 4.0
+        self.assertEqual(packages._get_production_packing_data()[packages[2].id]['quantity'], 4.0)
+        self.assertEqual(list(production._iter_package_labels())[-1]['quantity'], 4.0)
+
+    def test_allocations_follow_refresh(self):
+        production = self._create_production(2, remainder=5.0)
+        sale_order_1, sale_order_2 = self._link_sale_orders(production, [12.0, 13.0])
+        packages = production.action_put_in_pack().sorted('id')
+        production.qty_producing = 22.0
+        production.action_refresh_packages()
+        allocations = self.env['mrp.production.package.allocation'].search([('production_id', '=', production.id)])
+        self.assertEqual([(allocation.package_id, allocation.sale_order_id, allocation.quantity)
+                          for allocation in allocations], [
+            (packages[0], sale_order_1, 10.0),
+            (packages[1], sale_order_1, 2.0),
+            (packages[1], sale_order_2, 8.0),
+            (packages[2], sale_order_2, 2.0),
+        ])
+
+    def test_put_in_pack_batch(self):
+        # the orders are processed one by one in chunks, the orders of more than 10 packs are queued
+        self.env['ir.config_parameter'].sudo().set_param(PUT_IN_PACK_BATCH_SIZE_PARAM, 1)
+        self.env['ir.config_parameter'].sudo().set_param(ASYNC_PACK_THRESHOLD_PARAM, 10)
+        packed_production = self._create_production(2, remainder=5.0)
+        queued_production = self._create_production(20)
+        skipped_production = self._create_production(1)
+        skipped_production.qty_producing = 0.0
+        failed_production = self._create_production(3)
+        productions = packed_production | queued_production | skipped_production | failed_production
+        put_in_pack_according_to_packaging = type(productions)._put_in_pack_according_to_packaging
+
+        def _put_in_pack_according_to_packaging(production, *args, **kwargs):
+            if production == failed_production:
+                raise UserError('Packing failed')
+            return put_in_pack_according_to_packaging(production, *args, **kwargs)
+
+        with patch.object(type(productions), '_put_in_pack_according_to_packaging',
+                          _put_in_pack_according_to_packaging):
+            result = productions._put_in_pack_batch()
+        self.assertEqual(result['packed'], packed_production)
+        self.assertEqual(result['queued'], queued_production)
+        self.assertEqual(list(result['skipped']), [skipped_production])
+        self.assertEqual(result['failed'], {failed_production: 'Packing failed'})
+        self.assertEqual(self._get_quantities(packed_production), [10.0, 10.0, 5.0])
+        self.assertEqual(queued_production.pack_job_ids.state, 'pending')
+        # the failed order is rolled back
+        self.assertFalse(failed_production._get_related_packages())
+        self.assertFalse(queued_production._get_related_packages())
+
+    def test_mark_done_without_packages(self):
+        production = self._create_production(2, byproduct_count=1)
+        production._set_qty_producing()
+        product_move = production.move_finished_ids.filtered(lambda move: move.product_id == self.product)
+        move_lines = product_move.move_line_ids
+        self.assertEqual(sum(move_lines.mapped('qty_done')), 20.0)
+        # the move lines holding the producing quantity are kept, the by-product lines are set again
+        self.assertEqual(production._get_finished_move_lines_to_reset(),
+                         (production.move_finished_ids - product_move).move_line_ids)
+        production.qty_producing = 15.0
+        self.assertEqual(production._get_finished_move_lines_to_reset(), production.move_finished_ids.move_line_ids)
+        production.qty_producing = 20.0
+        production.button_mark_done()
+        self.assertEqual(production.state, 'done')
+        self.assertEqual(product_move.move_line_ids, move_lines)
+        self.assertEqual(product_move.quantity_done, 20.0)
+
+    def test_put_in_pack_token(self):
+        production = self._create_production(2)
+        token = production.pack_next_idempotency_token
+        self.assertTrue(token)
+        # the form buttons give the token shown by the form, it is renewed once the operation is done
+        packages = production.with_context(pack_idempotency_token=token).action_put_in_pack()
+        self.assertEqual(len(packages), 2)
+        self.assertEqual(production.pack_idempotency_token, token)
+        self.assertNotEqual(production.pack_next_idempotency_token, token)
+        # the button clicked twice on the same form does the operation once
+        result = production.with_context(pack_idempotency_token=token).action_put_in_pack()
+        self.assertEqual(result['tag'], 'display_notification')
+        self.assertEqual(production._get_related_packages(), packages)
+        self.assertEqual(self.env['stock.quant.package'].search_count([('production_id', '=', production.id)]), 2)
+        # the next operation of the form is not taken for the same one
+        with self.assertRaises(ValidationError):
+            production.with_context(
+                pack_idempotency_token=production.pack_next_idempotency_token).action_put_in_pack()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests.common import tagged
+
+from .common import TestMrpProductionPacksCommon
+
+# the query budgets of the packing entry points are a fixed part and at most the queries of the bulk creation of each
+# package, its insert and the one of its move line, so that any query added for each package goes over the budget
+QUERY_BUDGET = 150
+QUERY_BUDGET_BY_PACKAGE = 3
+# the read entry points are read by chunks of prefetched records
+QUERY_BUDGET_BY_PREFETCH_CHUNK = 10
+PREFETCH_CHUNK_SIZE = 1000
+
+
+@tagged('post_install', '-at_install')
+class TestPackagingQueryCount(TestMrpProductionPacksCommon):
+    """ Query count budgets of the packing entry points on orders of 10, 1,000 and 10,000 packs """
+
+    def _get_query_budget(self, package_count, by_package=True):
+        if by_package:
+            return QUERY_BUDGET + QUERY_BUDGET_BY_PACKAGE * package_count
+        return QUERY_BUDGET + QUERY_BUDGET_BY_PREFETCH_CHUNK * (package_count // PREFETCH_CHUNK_SIZE + 1)
+
+    def _check_query_counts(self, package_count):
+        production = self._create_production(package_count, remainder=5.0)
+        # the sale orders share a package
+        self._link_sale_orders(production, [package_count * 5.0 + 3.0, package_count * 5.0 + 2.0])
+        production.flush()
+
+        with self.assertQueryCount(self._get_query_budget(package_count)):
+            packages = production.action_put_in_pack()
+        self.assertEqual(len(packages), package_count + 1)
+
+        packages.invalidate_cache()
+        with self.assertQueryCount(self._get_query_budget(package_count, by_package=False)):
+            packages._get_forecasted_contents()
+        packages.invalidate_cache()
+        with self.assertQueryCount(self._get_query_budget(package_count, by_package=False)):
+            for package in packages:
+                package._get_sale_order()
+        packages.invalidate_cache()
+        with self.assertQueryCount(self._get_query_budget(package_count, by_package=False)):
+            packages._get_production_packing_data()
+        with self.assertQueryCount(self._get_query_budget(package_count, by_package=False)):
+            labels = list(production._iter_package_labels())
+        self.assertEqual(len(labels), package_count + 2)
+
+        # the quantity is doubled, the refresh adds as many packages
+        production.qty_producing *= 2
+        with self.assertQueryCount(self._get_query_budget(package_count)):
+            production._refresh_packages_with_qty_producing()
+        self.assertEqual(len(production._get_related_packages()), package_count * 2 + 1)
+
+        # the packaging is changed, the reset changes all the packages
+        production.product_packaging_id.qty = 5.0
+        production.invalidate_cache()
+        self.assertTrue(production.packages_to_reset)
+        with self.assertQueryCount(self._get_query_budget(package_count * 4)):
+            production.action_reset_packages()
+        self.assertEqual(len(production._get_related_packages()), package_count * 4 + 2)
+
+    def test_query_count_10_packs(self):
+        self._check_query_counts(10)
+
+    def test_query_count_1000_packs(self):
+        self._check_query_counts(1000)
+
+    def test_query_count_10000_packs(self):
+        self._check_query_counts(10000)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests.common import tagged
+
+from .common import TestMrpProductionPacksCommon
+
+
+@tagged('post_install', '-at_install')
+class TestPackingModes(TestMrpProductionPacksCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestPackingModes, cls).setUpClass()
+        cls.product = cls.env['product.product'].create({
+            'name': 'Product Of Several Packagings',
+            'type': 'product',
+            'uom_id': cls.uom_unit.id,
+            'uom_po_id': cls.uom_unit.id,
+        })
+        cls.carton_type, cls.case_type, cls.pallet_type, cls.row_type = cls.env['stock.package.type'].create([
+            {'name': 'Carton'}, {'name': 'Case'}, {'name': 'Pallet'}, {'name': 'Row'}])
+        cls.carton = cls._create_packaging(10.0, package_type=cls.carton_type)
+        # a case holds only one carton, it is no level of the nested packs
+        cls.case = cls._create_packaging(15.0, package_type=cls.case_type)
+        cls.pallet = cls._create_packaging(40.0, package_type=cls.pallet_type)
+        cls.row = cls._create_packaging(160.0, package_type=cls.row_type)
+
+    def _get_packages(self, production):
+        return self._get_package_move_lines(production).result_package_id
+
+    def test_mixed(self):
+        (self.case | self.row).unlink()
+        self._create_packaging(5.0, package_type=self.carton_type)
+        production = self._create_production(0, remainder=137.0, packaging=self.carton, packing_mode='mixed')
+        production.action_put_in_pack()
+        # the biggest packagings are filled first, the remaining quantity goes to a last pack of the smallest one
+        self.assertEqual(self._get_quantities(production), [40.0, 40.0, 40.0, 10.0, 5.0, 2.0])
+        self.assertEqual(self._get_packages(production).mapped('package_type_id'),
+                         self.pallet_type | self.carton_type)
+        packages = self._get_packages(production)
+        # the quantity changed, the packs of several packagings are reset
+        production.qty_producing = 150.0
+        production.invalidate_cache(['packages_to_reset'])
+        self.assertTrue(production.packages_to_reset)
+        production.action_reset_packages()
+        self.assertEqual(self._get_quantities(production), [40.0, 40.0, 40.0, 10.0, 10.0, 10.0])
+        self.assertFalse(packages.exists())
+
+    def test_mixed_selected_packaging_of_another_product(self):
+        (self.case | self.pallet | self.row).unlink()
+        other_product = self.env['product.product'].create({'name': 'Other Product', 'type': 'product'})
+        selected_packaging = self._create_packaging(20.0, product=other_product, package_type=self.case_type)
+        self._create_packaging(5.0, package_type=self.carton_type)
+        production = self._create_production(0, remainder=37.0, packaging=selected_packaging, packing_mode='mixed')
+        production.action_put_in_pack()
+        # the selected packaging is used with the packagings of the product
+        self.assertEqual(self._get_quantities(production), [20.0, 10.0, 5.0, 2.0])
+        self.assertEqual(self._get_packages(production)[0].package_type_id, self.case_type)
+
+    def test_nested(self):
+        production = self._create_production(9, remainder=5.0, packaging=self.carton, packing_mode='nested')
+        production.action_put_in_pack()
+        cartons = self._get_packages(production)
+        self.assertEqual(len(cartons), 10)
+        self.assertEqual(cartons.package_type_id, self.carton_type)
+        # the cartons are put on pallets of 4 cartons, the case holding one carton is skipped
+        pallets = cartons.parent_package_id
+        self.assertEqual(pallets.package_type_id, self.pallet_type)
+        self.assertEqual([len(pallet.child_package_ids) for pallet in pallets.sorted('id')], [4, 4, 2])
+        # the pallets are put in rows of 4 pallets
+        rows = pallets.parent_package_id
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows.package_type_id, self.row_type)
+        self.assertEqual(rows.child_package_ids, pallets)
+        self.assertFalse(rows.parent_package_id)
+        # the names of the parent packages are reserved in the order of the packages
+        parent_names = pallets.sorted('id').mapped('name')
+        self.assertEqual(parent_names, sorted(parent_names))
+        self.assertEqual(len(set(parent_names + rows.mapped('name') + cartons.mapped('name'))), 14)
+        # the quantity changed, the cartons and their parent packages are reset
+        production.qty_producing = 60.0
+        production.invalidate_cache(['packages_to_reset'])
+        self.assertTrue(production.packages_to_reset)
+        production.action_reset_packages()
+        self.assertFalse((cartons | pallets | rows).exists())
+        new_cartons = self._get_packages(production)
+        self.assertEqual(self._get_quantities(production), [10.0] * 6)
+        self.assertEqual([len(pallet.child_package_ids) for pallet in new_cartons.parent_package_id.sorted('id')],
+                         [4, 2])
+        self.assertEqual(len(new_cartons.parent_package_id.parent_package_id), 1)
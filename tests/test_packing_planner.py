@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from odoo.tests.common import BaseCase, tagged
+
+from odoo.addons.mrp_production_packs_according_packaging.tools.packing_planner import (
+    PackageRun, divmod_quantity, plan_partial_split, plan_packaging_split, plan_mixed_split, plan_refresh, plan_reconcile)
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('post_install', '-at_install')
+class TestPackingPlanner(BaseCase):
+    """ The planner has no database, its plans are checked on plain quantities """
+
+    def test_partial_split(self):
+        # the done quantity is packed, the quantity left to do stays on the original move line
+        self.assertEqual(plan_partial_split(4.0, 10.0, 0.01), (4.0, 6.0))
+        self.assertEqual(plan_partial_split(0.1, 0.3, 0.01), (0.1, 0.2))
+
+    def test_partial_split_not_split(self):
+        # a move line without done quantity is packed with its reserved quantity
+        self.assertEqual(plan_partial_split(0.0, 10.0, 0.01), (10.0, 0.0))
+        self.assertEqual(plan_partial_split(0.001, 10.0, 0.01), (10.0, 0.0))
+        # a move line fully done is packed as it is, even if more than reserved
+        self.assertEqual(plan_partial_split(10.0, 10.0, 0.01), (10.0, 0.0))
+        self.assertEqual(plan_partial_split(12.0, 10.0, 0.01), (12.0, 0.0))
+        self.assertEqual(plan_partial_split(9.999, 10.0, 0.01), (9.999, 0.0))
+
+    def test_packaging_split_full_and_remainder(self):
+        plan = plan_packaging_split(25.0, 10.0, 0.01, 1)
+        self.assertTrue(plan.split)
+        self.assertEqual(list(plan), [(10.0, 1), (10.0, 1), (5.0, 1)])
+        # the original move line is kept for the last full package
+        self.assertEqual(plan.source_index, 1)
+
+    def test_packaging_split_full_only(self):
+        plan = plan_packaging_split(30.0, 10.0, 0.01, 1)
+        self.assertEqual(plan.runs, (PackageRun(10.0, 1, 3),))
+        self.assertEqual(plan.source_index, 2)
+
+    def test_packaging_split_remainder_only(self):
+        plan = plan_packaging_split(5.0, 10.0, 0.01, 1)
+        self.assertFalse(plan.split)
+        self.assertEqual(list(plan), [(5.0, 1)])
+
+    def test_packaging_split_rounding(self):
+        # divmod(0.3, 0.1) gives 2 packages and a remainder of 0.0999..., which is a third full package
+        self.assertEqual(divmod_quantity(0.3, 0.1, 0.01), (3, 0.0))
+        plan = plan_packaging_split(0.3, 0.1, 0.01, 1)
+        self.assertEqual(plan.runs, (PackageRun(0.1, 1, 3),))
+        self.assertEqual(plan.source_index, 2)
+        # a remainder below the rounding is no package at all
+        self.assertEqual(list(plan_packaging_split(20.001, 10.0, 0.01, 1)), [(10.0, 1), (10.0, 1)])
+
+    def test_packaging_split_is_shared(self):
+        self.assertIs(plan_packaging_split(25.0, 10.0, 0.01, 1), plan_packaging_split(25.0, 10.0, 0.01, 1))
+
+    def test_mixed_split(self):
+        plan = plan_mixed_split(137.0, ((3, 5.0), (1, 100.0), (2, 10.0)), 0.01)
+        self.assertEqual(plan.runs, (PackageRun(100.0, 1, 1), PackageRun(10.0, 2, 3), PackageRun(5.0, 3, 1),
+                                     PackageRun(2.0, 3, 1)))
+        self.assertEqual(plan.source_index, 0)
+        self.assertEqual(len(plan), 6)
+
+    def test_mixed_split_rounding(self):
+        plan = plan_mixed_split(0.7, ((1, 0.5), (2, 0.1)), 0.01)
+        self.assertEqual(plan.runs, (PackageRun(0.5, 1, 1), PackageRun(0.1, 2, 2)))
+
+    def test_refresh_decrease(self):
+        plan = plan_refresh([10.0, 10.0, 5.0], -12.0, 10.0, 0.01)
+        self.assertEqual(plan.removals, [2])
+        self.assertEqual(plan.updates, {1: 3.0})
+        self.assertEqual(len(plan.additions), 0)
+        # the removal stops exactly on a package
+        plan = plan_refresh([10.0, 10.0, 5.0], -15.0, 10.0, 0.01)
+        self.assertEqual(plan.removals, [2, 1])
+        self.assertEqual(plan.updates, {})
+
+    def test_refresh_increase(self):
+        plan = plan_refresh([10.0, 10.0, 5.0], 27.0, 10.0, 0.01)
+        self.assertEqual(plan.removals, [])
+        self.assertEqual(plan.updates, {2: 10.0})
+        self.assertEqual(list(plan.additions), [(10.0, None), (10.0, None), (2.0, None)])
+
+    def test_refresh_rounding(self):
+        plan = plan_refresh([0.1, 0.1], 0.1, 0.1, 0.01)
+        self.assertEqual(plan.updates, {})
+        self.assertEqual(list(plan.additions), [(0.1, None)])
+        plan = plan_refresh([0.1, 0.1, 0.1], -0.2, 0.1, 0.01)
+        self.assertEqual(plan.removals, [2, 1])
+        self.assertEqual(plan.updates, {})
+
+    def test_reconcile(self):
+        plan = plan_reconcile([10.0, 10.0, 5.0], 37.0, 12.0, 0.01)
+        self.assertEqual(plan.removals, [])
+        self.assertEqual(plan.updates, {0: 12.0, 1: 12.0, 2: 12.0})
+        self.assertEqual(list(plan.additions), [(1.0, None)])
+        plan = plan_reconcile([12.0, 12.0, 12.0, 1.0], 25.0, 12.0, 0.01)
+        self.assertEqual(plan.removals, [3])
+        self.assertEqual(plan.updates, {2: 1.0})
+        self.assertEqual(len(plan.additions), 0)
+
+    def test_reconcile_reserved_quantity(self):
+        plan = plan_reconcile([10.0, 5.0], 15.0, 10.0, 0.01, [10.0, 0.0])
+        self.assertEqual(plan.updates, {1: 5.0})
+
+    def test_reconcile_rounding(self):
+        plan = plan_reconcile([0.1, 0.1, 0.1], 0.3, 0.1, 0.01)
+        self.assertEqual((plan.removals, plan.updates, len(plan.additions)), ([], {}, 0))
+
+    def test_planning_time(self):
+        """ The plans are runs of identical packages, planning millions of units takes microseconds """
+        plan_packaging_split.cache_clear()
+        plan_mixed_split.cache_clear()
+        start = time.perf_counter()
+        plan = plan_packaging_split(5000000.0, 7.0, 0.01, 1)
+        mixed_plan = plan_mixed_split(5000000.0, ((1, 700.0), (2, 7.0), (3, 3.0)), 0.01)
+        refresh_plan = plan_refresh([7.0] * 10, 5000000.0, 7.0, 0.01)
+        duration = time.perf_counter() - start
+        _logger.info("Planned 3 x 5000000 units in %.6fs", duration)
+        self.assertEqual(len(plan), 714286)
+        self.assertEqual(len(plan.runs), 2)
+        self.assertLessEqual(len(mixed_plan.runs), 4)
+        self.assertEqual(len(refresh_plan.additions.runs), 2)
+        self.assertLess(duration, 0.01)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from odoo.tests.common import tagged
+
+from .common import TestMrpProductionPacksCommon
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('post_install', '-at_install')
+class TestPutInPack(TestMrpProductionPacksCommon):
+
+    def _put_in_pack_per_package(self, production):
+        """ The packing of the move lines one package at a time as it was done before the bulk creation, one copy of
+        the move line, one package creation and one write by package """
+        production._update_move_finished_ids()
+        production.move_finished_ids._action_assign()
+        packaging = production.product_packaging_id
+        move_lines = production.finished_move_line_ids.filtered(lambda ml: ml.qty_done > 0 and not ml.result_package_id)
+        for move_line in move_lines:
+            nbr_of_packages = int(move_line.qty_done // packaging.qty)
+            last_package = move_line.qty_done % packaging.qty
+            is_assigned = move_line.state == 'assigned'
+            if not nbr_of_packages:
+                production._pack_move_line(move_line, packaging)
+                continue
+            for index in range(nbr_of_packages - 1):
+                production._pack_move_line(move_line.copy({
+                    'product_uom_qty': is_assigned and packaging.qty or 0.0,
+                    'qty_done': packaging.qty,
+                }), packaging)
+            move_line.write({
+                'product_uom_qty': is_assigned and packaging.qty or 0.0,
+                'qty_done': packaging.qty,
+            })
+            production._pack_move_line(move_line, packaging)
+            if last_package:
+                production._pack_move_line(move_line.copy({
+                    'product_uom_qty': is_assigned and last_package or 0.0,
+                    'qty_done': last_package,
+                }), packaging)
+
+    def _assert_same_as_per_package(self, package_count, remainder):
+        packaging = self._create_packaging(10.0)
+        production = self._create_production(package_count, packaging=packaging, remainder=remainder)
+        reference_production = self._create_production(package_count, packaging=packaging, remainder=remainder)
+        packages = production.action_put_in_pack()
+        self._put_in_pack_per_package(reference_production)
+        self.assertEqual(len(packages), package_count + (remainder and 1 or 0))
+        self.assertEqual(self._get_package_layout(production), self._get_package_layout(reference_production))
+        self.assertEqual(sum(production.move_finished_ids.filtered(
+            lambda move: move.product_id == production.product_id).mapped('quantity_done')), production.qty_producing)
+        # each package is linked to its move line and numbered in the order
+        self.assertEqual(packages.mapped('production_id'), production)
+        self.assertEqual(packages.mapped('production_move_line_id.result_package_id'), packages)
+        self.assertEqual(packages.sorted('id').mapped('production_sequence'), list(range(1, len(packages) + 1)))
+
+    def test_full_packages(self):
+        self._assert_same_as_per_package(3, 0.0)
+
+    def test_remainder_package_only(self):
+        self._assert_same_as_per_package(0, 4.0)
+
+    def test_full_and_remainder_packages(self):
+        self._assert_same_as_per_package(3, 4.0)
+
+    def test_benchmark(self):
+        """ Record the query count and the wall time of the put in pack of orders of 100, 1,000 and 10,000 packs """
+        for package_count in (100, 1000, 10000):
+            production = self._create_production(package_count, packaging_qty=1.0)
+            self.env['base'].flush()
+            query_count = self.cr.sql_log_count
+            start = time.time()
+            packages = production.action_put_in_pack()
+            self.env['base'].flush()
+            duration = time.time() - start
+            query_count = self.cr.sql_log_count - query_count
+            _logger.info("Put in pack of %s packs: %s queries in %.2fs", package_count, query_count, duration)
+            self.assertEqual(len(packages), package_count)
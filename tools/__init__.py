@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+from . import pack_profiling
+from . import packing_planner
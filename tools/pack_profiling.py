@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+PROFILE_PACK_OPERATIONS_PARAM = 'mrp_production_packs_according_packaging.profile_pack_operations'
+PACK_OPERATION_COUNTERS = ('packages_created', 'packages_removed', 'move_lines_split')
+
+_profiled_operations = threading.local()
+
+
+def _get_profiled_operations():
+    if not hasattr(_profiled_operations, 'stack'):
+        _profiled_operations.stack = []
+    return _profiled_operations.stack
+
+
+def profile_pack_operation(method):
+    """ Log the query count, the wall time and the pack counters of each call of the decorated method when the
+    profile_pack_operations system parameter is set, the counters of nested profiled calls are added to the caller """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.env['ir.config_parameter'].sudo().get_param(PROFILE_PACK_OPERATIONS_PARAM):
+            return method(self, *args, **kwargs)
+        profiled_operations = _get_profiled_operations()
+        counters = dict.fromkeys(PACK_OPERATION_COUNTERS, 0)
+        profiled_operations.append(counters)
+        query_count = self.env.cr.sql_log_count
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            duration = time.time() - start
+            profiled_operations.pop()
+            if profiled_operations:
+                for counter, value in counters.items():
+                    profiled_operations[-1][counter] += value
+            _logger.info(
+                "pack_operation=%s.%s records=%s ids=%s queries=%d duration=%.3f packages_created=%d "
+                "packages_removed=%d move_lines_split=%d",
+                self._name, method.__name__, len(self), self.ids[:10], self.env.cr.sql_log_count - query_count,
+                duration, counters['packages_created'], counters['packages_removed'], counters['move_lines_split'])
+
+    return wrapper
+
+
+def count_pack_operation(counter, value):
+    """ Add value to the counter of the innermost profiled pack operation, if any """
+    profiled_operations = _get_profiled_operations()
+    if profiled_operations:
+        profiled_operations[-1][counter] += value
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+""" Packing arithmetic of manufacturing orders, independent from the ORM so that it can be planned and benchmarked
+without database. The planners only work on quantities and packaging keys (the packaging ids for the ORM layer) and
+return declarative plans that the ORM layer applies in bulk. The plans hold runs of identical packages instead of one
+record by package, so that planning millions of units takes the same time as planning a few of them, and the split
+planners are cached so that the orders sharing a packaging and a quantity share the same plan. """
+
+import functools
+import math
+
+PLAN_CACHE_SIZE = 1024
+
+
+def float_round(value, rounding):
+    """ Round value to a multiple of rounding, half up, as odoo.tools.float_utils.float_round does """
+    normalized_value = value / rounding
+    epsilon_magnitude = math.log(abs(normalized_value), 2) if normalized_value else 0
+    epsilon = 2 ** (epsilon_magnitude - 52)
+    normalized_value += math.copysign(epsilon, normalized_value)
+    return round(normalized_value) * rounding
+
+
+def float_is_zero(value, rounding):
+    return abs(float_round(value, rounding)) < rounding
+
+
+def float_compare(value1, value2, rounding):
+    value1 = float_round(value1, rounding)
+    value2 = float_round(value2, rounding)
+    delta = value1 - value2
+    if float_is_zero(delta, rounding):
+        return 0
+    return -1 if delta < 0.0 else 1
+
+
+class PackageRun(object):
+    """ count packages of the same quantity and packaging key """
+    __slots__ = ('quantity', 'packaging', 'count')
+
+    def __init__(self, quantity, packaging, count=1):
+        self.quantity = quantity
+        self.packaging = packaging
+        self.count = count
+
+    def __eq__(self, other):
+        return isinstance(other, PackageRun) and (self.quantity, self.packaging, self.count) == (
+            other.quantity, other.packaging, other.count)
+
+    def __repr__(self):
+        return 'PackageRun(%r, %r, %r)' % (self.quantity, self.packaging, self.count)
+
+
+class PackingPlan(object):
+    """ The packages a quantity is split in as runs of identical packages, ordered as they have to be created. Iterating
+    a plan yields the (quantity, packaging) of each package lazily. The package at source_index keeps the original move
+    line, the other ones are copies of it. If split is False the quantity fits in one package and the move line is
+    packed as it is """
+    __slots__ = ('runs', 'source_index', 'split')
+
+    def __init__(self, runs=(), source_index=0, split=True):
+        self.runs = tuple(run for run in runs if run.count > 0)
+        self.source_index = source_index
+        self.split = split
+
+    def __len__(self):
+        return sum(run.count for run in self.runs)
+
+    def __iter__(self):
+        for run in self.runs:
+            for index in range(run.count):
+                yield run.quantity, run.packaging
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        for run in self.runs:
+            if index < run.count:
+                return run.quantity, run.packaging
+            index -= run.count
+        raise IndexError(index)
+
+    def starting_at(self, start):
+        """ Return the plan of the packages of this plan from the index start """
+        runs = []
+        for run in self.runs:
+            if start < run.count:
+                runs.append(PackageRun(run.quantity, run.packaging, run.count - start))
+            start = max(start - run.count, 0)
+        return PackingPlan(runs, split=self.split)
+
+    def __repr__(self):
+        return 'PackingPlan(%r, source_index=%r, split=%r)' % (self.runs, self.source_index, self.split)
+
+
+class DeltaPlan(object):
+    """ The changes to bring existing packages to a new quantity: the indexes of the packages to remove, the new
+    quantity of the packages to update by index and the plan of the packages to add after the existing ones """
+    __slots__ = ('removals', 'updates', 'additions')
+
+    def __init__(self, removals=(), updates=None, additions=None):
+        self.removals = list(removals)
+        self.updates = dict(updates or {})
+        self.additions = additions or PackingPlan()
+
+    def __repr__(self):
+        return 'DeltaPlan(removals=%r, updates=%r, additions=%r)' % (self.removals, self.updates, self.additions)
+
+
+def divmod_quantity(quantity, packaging_qty, rounding):
+    """ Return the number of full packages of packaging_qty in quantity and the rounded remaining quantity, a remainder
+    equal to packaging_qty up to the rounding, as 0.3 in packs of 0.1, counts as a full package """
+    nbr_of_packages, remaining_qty = divmod(quantity, packaging_qty)
+    nbr_of_packages = int(nbr_of_packages)
+    remaining_qty = float_round(remaining_qty, rounding)
+    if float_compare(remaining_qty, packaging_qty, rounding) >= 0:
+        nbr_of_packages += 1
+        remaining_qty = float_round(remaining_qty - packaging_qty, rounding)
+    if float_is_zero(remaining_qty, rounding):
+        remaining_qty = 0.0
+    return nbr_of_packages, remaining_qty
+
+
+def split_quantity(quantity, packaging_qty, rounding, packaging=None):
+    """ Return the runs of packages quantity fills, full packages first and a last incomplete one """
+    nbr_of_packages, remaining_qty = divmod_quantity(quantity, packaging_qty, rounding)
+    runs = [PackageRun(packaging_qty, packaging, nbr_of_packages)]
+    if remaining_qty:
+        runs.append(PackageRun(remaining_qty, packaging))
+    return runs
+
+
+def plan_partial_split(qty_done, product_uom_qty, rounding):
+    """ Plan the split of a move line partially done before it is packed, return the quantity to pack and the quantity
+    left to do: the done quantity goes to a copy of the move line which is packed, the original move line keeps the
+    quantity left to do. A move line without done quantity is packed with all its reserved quantity and a move line
+    fully done is packed as it is, its quantity left to do is 0.0 """
+    if float_is_zero(qty_done, rounding):
+        qty_done = product_uom_qty
+    if float_compare(qty_done, product_uom_qty, rounding) >= 0:
+        return qty_done, 0.0
+    return qty_done, float_round(product_uom_qty - qty_done, rounding)
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def plan_packaging_split(quantity, packaging_qty, rounding, packaging=None):
+    """ Plan the split of quantity in packages of packaging, the original move line is kept for the last full package
+    and the packages before it are copies, as well as the last incomplete package """
+    nbr_of_packages, remaining_qty = divmod_quantity(quantity, packaging_qty, rounding)
+    if not nbr_of_packages:
+        # the quantity is less then the capacity of the packaging, it is not splitted at all
+        return PackingPlan([PackageRun(quantity, packaging)], split=False)
+    return PackingPlan(split_quantity(quantity, packaging_qty, rounding, packaging), source_index=nbr_of_packages - 1)
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def plan_mixed_split(quantity, packagings, rounding):
+    """ Plan the split of quantity in packages of packagings, a tuple of (packaging, capacity): the biggest packagings
+    are filled first and the remaining quantity goes to the smaller ones, what doesn't fill the smallest packaging
+    is put in a last incomplete package of it. The original move line is kept for the first package """
+    packagings = sorted(packagings, key=lambda packaging: packaging[1], reverse=True)
+    remaining_qty = quantity
+    runs = []
+    for packaging, packaging_qty in packagings:
+        nbr_of_packages, remaining_qty = divmod_quantity(remaining_qty, packaging_qty, rounding)
+        runs.append(PackageRun(packaging_qty, packaging, nbr_of_packages))
+    if remaining_qty:
+        runs.append(PackageRun(remaining_qty, packagings[-1][0]))
+    return PackingPlan(runs)
+
+
+def plan_refresh(packages_qty, quantity_delta, packaging_qty, rounding):
+    """ Plan the change of packages_qty, the quantities of the existing packages in their order, by quantity_delta:
+    a decrease removes the packages from the last one and reduces the package where the removal stops, an increase
+    tops up the last package if incomplete then adds full packages and a last incomplete one """
+    plan = DeltaPlan()
+    if float_compare(quantity_delta, 0.0, rounding) < 0:
+        qty_to_remove = -quantity_delta
+        qty_removed = 0.0
+        for index in range(len(packages_qty) - 1, -1, -1):
+            qty_removed += packages_qty[index]
+            removed_compare = float_compare(qty_removed, qty_to_remove, rounding)
+            if removed_compare > 0:
+                plan.updates[index] = float_round(qty_removed - qty_to_remove, rounding)
+                break
+            plan.removals.append(index)
+            if removed_compare == 0:
+                break
+    elif float_compare(quantity_delta, 0.0, rounding) > 0:
+        qty_to_add = quantity_delta
+        if packages_qty and float_compare(packages_qty[-1], packaging_qty, rounding) < 0:
+            qty_to_complete_package = min(packaging_qty - packages_qty[-1], qty_to_add)
+            plan.updates[len(packages_qty) - 1] = float_round(packages_qty[-1] + qty_to_complete_package, rounding)
+            qty_to_add -= qty_to_complete_package
+        plan.additions = PackingPlan(split_quantity(qty_to_add, packaging_qty, rounding))
+    return plan
+
+
+def plan_reconcile(packages_qty, quantity, packaging_qty, rounding, packages_reserved_qty=None):
+    """ Plan the changes of packages_qty, the quantities of the existing packages in their order, to reach the layout
+    of quantity split in full packages and a last incomplete one: the packages matching the layout are kept, the
+    other ones are updated, the extra ones removed and the missing ones added. The packages whose reserved quantity,
+    given by packages_reserved_qty, doesn't match the layout are updated too """
+    target_plan = PackingPlan(split_quantity(quantity, packaging_qty, rounding))
+    target_count = len(target_plan)
+    plan = DeltaPlan(removals=range(target_count, len(packages_qty)), additions=target_plan.starting_at(
+        len(packages_qty)))
+    for index, (package_qty, (target_qty, target_packaging)) in enumerate(zip(packages_qty, target_plan)):
+        if float_compare(package_qty, target_qty, rounding) != 0 or (
+                packages_reserved_qty and float_compare(packages_reserved_qty[index], target_qty, rounding) != 0):
+            plan.updates[index] = target_qty
+    return plan